@@ -3,7 +3,13 @@ sys.path.append(os.getcwd() + '/src/')
 
 from ud_tools import *
 import pyarabic.araby as araby
-import copy
+
+def remove_diacritics(sent):
+    """Strip the diacritics from all forms and lemmas of a sentence (in place)."""
+    for token in sent:
+        token['form'] = araby.strip_diacritics(token['form'])
+        token['lemma'] = araby.strip_diacritics(token['lemma'])
+    return sent
 
 if __name__=="__main__":
     tb_path_mod = "data/ud-mod/"
@@ -14,15 +20,8 @@ if __name__=="__main__":
     }
     splits = ['train', 'dev', 'test']
     for split in splits:
-        sents = load_ud_treebank(tbs_in[split], no_trees=True)
+        # stream the sentences, so only one sentence is in memory at a time
+        sents = load_ud_treebank(tbs_in[split], no_trees=True, stream=True)
         # remove diacritics
         print('remove diacritics for ', split)
-        print('num of sents: ', len(sents))
-        sents_without_dia = list()
-        for sent in sents:
-            sent_new = copy.deepcopy(sent)
-            for token in sent_new:
-                token['form'] = araby.strip_diacritics(token['form'])
-                token['lemma'] = araby.strip_diacritics(token['lemma'])
-            sents_without_dia.append(sent_new)
-        serialize_sents_to_conllu_file(sents_without_dia, f"{tb_path_mod}UD_Arabic-PADT/ar_padt-ud-{split}.conllu")
+        serialize_sents_to_conllu_file(map(remove_diacritics, sents), f"{tb_path_mod}UD_Arabic-PADT/ar_padt-ud-{split}.conllu")
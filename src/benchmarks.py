@@ -0,0 +1,315 @@
+import os, sys
+sys.path.append(os.getcwd() + '/src/')
+
+import multiprocessing as mp
+import random
+import time
+import tracemalloc
+
+from conllu import Token, TokenList
+
+from ud_tools import *
+from syntactic_patterns import *
+from morph_dict_tools.universal import *
+
+
+def benchmark_parallel_parsing(filenames, num_processes=None):
+    """Compares serial and multi-process parsing of treebank files.
+
+    :param filenames: a list of CoNLL-U files
+    :param num_processes: the number of processes for the parallel parse. Default: all cores
+    :return: a dict filename -> dict of timings, speedup and whether the outputs are identical
+    """
+    num_processes = num_processes or mp.cpu_count()
+    results = dict()
+    for filename in filenames:
+        start = time.perf_counter()
+        serial = parse_ud_file(filename)
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parallel = parse_ud_file(filename, num_processes=num_processes)
+        parallel_time = time.perf_counter() - start
+
+        results[filename] = {
+            'sentences': len(serial),
+            'serial (s)': serial_time,
+            f'{num_processes} processes (s)': parallel_time,
+            'speedup': serial_time / parallel_time,
+            'identical': serial == parallel,
+        }
+        print(filename, results[filename])
+    return results
+
+
+def find_subtree_with_dfs(dep_tree, i):
+    """The tree search that find_subtree_with_token_ix used before the subtree index. Baseline only."""
+    if dep_tree.token['id'] == i:
+        return dep_tree
+    for c in dep_tree.children:
+        in_children = find_subtree_with_dfs(c, i)
+        if in_children is not None:
+            return in_children
+    return None
+
+
+def benchmark_children_index(filename, min_length=60, pattern_config=None, cutoff=None):
+    """Compares deprel signature lookups with a DFS per token and with the subtree index.
+
+    Runs find_deprels_to_children for every token of the sentences with at least
+    min_length tokens, the way find_matches_for_token does during replacement.
+
+    :param filename: a CoNLL-U file, e.g. the HDT train set
+    :param min_length: only sentences with at least this many tokens are used
+    :param pattern_config: the pattern config, e.g. pattern_configs['de']
+    :param cutoff: the number of sentences to load
+    :return: a dict of timings and whether both ways give the same signatures
+    """
+    dep_sents, dep_trees = load_ud_treebank(filename, verbose=False, cutoff=cutoff)
+    long_trees = [tree for sent, tree in zip(dep_sents, dep_trees) if len(sent) >= min_length]
+    synt_patterns = SyntacticPatterns(long_trees, pattern_config=dict(pattern_config or dict()))
+    # tree tokens only: multiword token ranges and empty nodes are not part of the trees
+    token_ids = [[t['id'] for t in sent if isinstance(t['id'], int)] for sent in dep_sents if len(sent) >= min_length]
+
+    start = time.perf_counter()
+    with_dfs = [[synt_patterns.find_deprels_to_children_of_subtree(find_subtree_with_dfs(tree, i)) for i in ids] 
+                for tree, ids in zip(long_trees, token_ids)]
+    dfs_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with_index = [[synt_patterns.find_deprels_to_children(tree, i) for i in ids] 
+                  for tree, ids in zip(long_trees, token_ids)]
+    index_time = time.perf_counter() - start
+
+    results = {
+        'sentences': len(long_trees),
+        'tokens': sum(len(ids) for ids in token_ids),
+        'dfs (s)': dfs_time,
+        'index (s)': index_time,
+        'speedup': dfs_time / index_time,
+        'identical': with_dfs == with_index,
+    }
+    print(filename, results)
+    return results
+
+
+def build_nested_patterns_dict(patterns):
+    """The nested upos -> deprel -> str(deprels_to_children) -> list of (form, lemma) dict 
+    that SyntacticPatterns used before the CSR buckets. Baseline only."""
+    patterns_dict = dict()
+    for (form,lemma,deprel,upos,deprels_to_children) in set(patterns):
+        patterns_dict.setdefault(upos, dict()).setdefault(deprel, dict()).setdefault(
+            str(list(deprels_to_children)), []).append((form,lemma))
+    return patterns_dict
+
+
+def benchmark_pattern_memory(filename, pattern_config=None, upos_filter=None, cutoff=None):
+    """Compares the memory of the nested patterns dict and of the CSR pattern index.
+
+    Both are built from the same aggregated patterns, and the memory allocated 
+    while building them is measured with tracemalloc.
+
+    :param filename: a CoNLL-U file, e.g. the HDT or SynTagRus train set
+    :param pattern_config: the pattern config, e.g. pattern_configs['de']
+    :param upos_filter: the upos tags to collect patterns for
+    :param cutoff: the number of sentences to load
+    :return: a dict of memory sizes, timings and whether both give the same matches
+    """
+    compact_treebank = load_ud_treebank(filename, verbose=False, cutoff=cutoff, compact=True)
+    synt_patterns = SyntacticPatterns(compact_treebank, upos_filter=upos_filter, pattern_config=dict(pattern_config or dict()))
+    patterns = synt_patterns.aggregate_patterns_from_treebank(compact_treebank, upos_filter=upos_filter)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    patterns_dict = build_nested_patterns_dict(patterns)
+    dict_time = time.perf_counter() - start
+    dict_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    synt_patterns.build_index(patterns)
+    index_time = time.perf_counter() - start
+    index_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    identical = all(
+        set(matches) == set(synt_patterns.find_matches(upos, deprel, deprels_to_children))
+        for upos in patterns_dict 
+        for deprel in patterns_dict[upos] 
+        for deprels_to_children, matches in patterns_dict[upos][deprel].items())
+    results = {
+        'patterns': synt_patterns.num_patterns,
+        'signatures': len(synt_patterns.signatures),
+        'nested dict (MB)': dict_memory / 2**20,
+        'index (MB)': index_memory / 2**20,
+        'nested dict (s)': dict_time,
+        'index (s)': index_time,
+        'identical': identical,
+    }
+    print(filename, results)
+    return results
+
+
+def benchmark_parallel_patterns(filename, num_processes=None, pattern_config=None, upos_filter=None, cutoff=None):
+    """Compares the serial and the parallel build of the pattern index.
+
+    :param filename: a CoNLL-U file, e.g. the HDT train set
+    :param num_processes: the number of processes for the parallel build. Default: all cores
+    :param pattern_config: the pattern config, e.g. pattern_configs['de']
+    :param upos_filter: the upos tags to collect patterns for
+    :param cutoff: the number of sentences to load
+    :return: a dict of timings, speedup and whether both builds give the same patterns
+    """
+    num_processes = num_processes or mp.cpu_count()
+    compact_treebank = load_ud_treebank(filename, verbose=False, cutoff=cutoff, compact=True)
+
+    start = time.perf_counter()
+    serial = SyntacticPatterns(compact_treebank, upos_filter=upos_filter, pattern_config=dict(pattern_config or dict()))
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel = SyntacticPatterns(compact_treebank, upos_filter=upos_filter, pattern_config=dict(pattern_config or dict()), 
+                                 num_processes=num_processes)
+    parallel_time = time.perf_counter() - start
+
+    results = {
+        'patterns': serial.num_patterns,
+        'serial (s)': serial_time,
+        f'{num_processes} processes (s)': parallel_time,
+        'speedup': serial_time / parallel_time,
+        'identical': serial.patterns_dict == parallel.patterns_dict,
+    }
+    print(filename, results)
+    return results
+
+
+def find_patterns_recursive(synt_patterns, dep_tree, patterns):
+    """The recursive find_patterns that SyntacticPatterns used before the iterative walk. Baseline only."""
+    upos = dep_tree.token['upos']
+    deprels_to_children = synt_patterns.find_deprels_to_children_of_subtree(dep_tree)
+    patterns.append((dep_tree.token['form'], dep_tree.token['lemma'], dep_tree.token['deprel'], upos, tuple(deprels_to_children)))
+    for c in dep_tree.children:
+        patterns = find_patterns_recursive(synt_patterns, c, patterns)
+    return patterns
+
+
+def make_random_sentence(length, rng):
+    """A tokenlist with length tokens and a random tree (the head of each token is a random earlier token)."""
+    upos_tags, deprels = ['NOUN', 'VERB', 'ADJ', 'ADP', 'DET'], ['nsubj', 'obj', 'amod', 'case', 'det', 'nmod', 'obl']
+    tokens = []
+    for i in range(1, length + 1):
+        upos = rng.choice(upos_tags)
+        tokens.append(Token({
+            'id': i, 'form': upos.lower() + str(i), 'lemma': upos.lower(), 'upos': upos, 'xpos': None, 'feats': None,
+            'head': 0 if i == 1 else rng.randint(1, i - 1), 'deprel': 'root' if i == 1 else rng.choice(deprels),
+            'deps': None, 'misc': None}))
+    return TokenList(tokens)
+
+
+def benchmark_pattern_extraction(lengths=(25, 50, 100, 200, 400, 800, 1600, 3200), tokens_per_length=50000, pattern_config=None):
+    """Measures how pattern extraction scales with sentence length.
+
+    For each length, random sentences with about tokens_per_length tokens in total are 
+    built, and their patterns are extracted from the trees (iteratively and with 
+    the recursive baseline) and from a CompactTreebank. Linear scaling shows as a 
+    constant time per token.
+
+    :param lengths: the sentence lengths
+    :param tokens_per_length: the number of tokens per length
+    :param pattern_config: the pattern config, e.g. pattern_configs['de']
+    :return: a dict length -> dict of microseconds per token and whether all ways give the same patterns
+    """
+    rng = random.Random(0)
+    results = dict()
+    for length in lengths:
+        dep_sents = [make_random_sentence(length, rng) for _ in range(max(tokens_per_length // length, 1))]
+        dep_trees = [dep_sent.to_tree() for dep_sent in dep_sents]
+        compact_treebank = CompactTreebank.from_sents(dep_sents)
+        synt_patterns = SyntacticPatterns(dep_trees[:1], pattern_config=dict(pattern_config or dict()))
+        num_tokens = sum(len(dep_sent) for dep_sent in dep_sents)
+
+        start = time.perf_counter()
+        iterative = [synt_patterns.find_patterns(tree) for tree in dep_trees]
+        iterative_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        recursive = [find_patterns_recursive(synt_patterns, tree, []) for tree in dep_trees]
+        recursive_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compact = synt_patterns.aggregate_patterns_from_compact_treebank(compact_treebank)
+        compact_time = time.perf_counter() - start
+
+        results[length] = {
+            'sentences': len(dep_sents),
+            'iterative (us/token)': 1e6 * iterative_time / num_tokens,
+            'recursive (us/token)': 1e6 * recursive_time / num_tokens,
+            'compact (us/token)': 1e6 * compact_time / num_tokens,
+            'identical': iterative == recursive and sorted(compact) == sorted(p for ps in iterative for p in ps),
+        }
+        print(length, results[length])
+    return results
+
+
+def benchmark_feature_masks(morphdict, filename, upos='VERB', num_lemmas=50, cutoff=1000):
+    """Compares matching ufeats with all1in2 over dicts and with the bitmasks of FeatureCandidates.
+
+    The ufeats of every token with the upos in the treebank are matched with the lexicon 
+    entries of num_lemmas random lemmas, the way lang_specific_lookup does.
+
+    :param morphdict: a MorphDict, e.g. load_morphdict_from_pickle('ru')
+    :param filename: a CoNLL-U file, e.g. the SynTagRus dev set
+    :param upos: the upos of the tokens and lemmas
+    :param num_lemmas: the number of lemmas to match every token with
+    :param cutoff: the number of sentences to load
+    :return: a dict of timings and whether both ways give the same forms
+    """
+    dep_sents = load_ud_treebank(filename, verbose=False, cutoff=cutoff, no_trees=True)
+    targets = [dict(tok['feats'] or dict()) for sent in dep_sents for tok in sent if tok['upos'] == upos]
+    lemmas = sorted(morphdict.upos2lemma2ufeatdictandform[upos])
+    lemmas = random.Random(0).sample(lemmas, min(num_lemmas, len(lemmas)))
+
+    start = time.perf_counter()
+    candidates = [morphdict.feature_candidates(upos, lemma) for lemma in lemmas]
+    compile_time = time.perf_counter() - start
+
+    entries = [morphdict.upos2lemma2ufeatdictandform[upos][lemma] for lemma in lemmas]
+    start = time.perf_counter()
+    with_dicts = [[form for form,ufeatdict in e if all1in2(target,ufeatdict)] for target in targets for e in entries]
+    dicts_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with_masks = [c.matching_forms(target) for target in targets for c in candidates]
+    masks_time = time.perf_counter() - start
+
+    results = {
+        'tokens': len(targets),
+        'entries per lemma': sum(len(c) for c in candidates) / max(len(candidates), 1),
+        'compile lexicon (s)': compile_time,
+        'dicts (s)': dicts_time,
+        'bitmasks (s)': masks_time,
+        'speedup': dicts_time / masks_time,
+        'identical': with_dicts == with_masks,
+    }
+    print(filename, upos, results)
+    return results
+
+
+if __name__ == '__main__':
+    from generate_data_multiprocess import tb_paths
+
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'parsing'
+    if benchmark == 'parsing':
+        benchmark_parallel_parsing([tb_paths[lang]["train"][0] for lang in tb_paths])
+    elif benchmark == 'children_index':
+        benchmark_children_index(tb_paths["de"]["train"][0], pattern_config=pattern_configs["de"])
+    elif benchmark == 'pattern_extraction':
+        benchmark_pattern_extraction(pattern_config=pattern_configs["de"])
+    elif benchmark == 'parallel_patterns':
+        benchmark_parallel_patterns(tb_paths["de"]["train"][0], pattern_config=pattern_configs["de"])
+    elif benchmark == 'feature_masks':
+        benchmark_feature_masks(load_morphdict_from_pickle("ru"), tb_paths["ru"]["dev"][0])
+    elif benchmark == 'pattern_memory':
+        for lang in ["de", "ru"]: # HDT, SynTagRus
+            benchmark_pattern_memory(tb_paths[lang]["train"][0], pattern_config=pattern_configs[lang])
@@ -0,0 +1,195 @@
+import os, sys
+sys.path.append(os.getcwd() + '/src/')
+
+import itertools
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from generate_data_multiprocess import *
+
+
+def check_seeded_replacement(lang, sents, morphdict, synt_patterns, upos_filter=None, process_counts=(1, 2, 8),
+                             seed=42, num_variants=2):
+    """Checks that seeded parallel replacement writes the same files for any number of processes.
+
+    The treebank is replaced with parallel_replacement once per process count, with the
+    same seed, and the output files of all variants (or the one output file without 
+    num_variants) are compared byte by byte with those of the first process count. Every process count splits the treebank into
+    other slices, so this also checks that no lookup depends on the lookups before it.
+
+    :param lang: the language, see make_replacer
+    :param sents: a list of tokenlists, or a CompactTreebank
+    :param morphdict: a MorphDict object
+    :param synt_patterns: a SyntacticPatterns object
+    :param upos_filter: a list of upos to replace
+    :param process_counts: the numbers of processes to compare
+    :param seed: the global seed
+    :param num_variants: the number of variants per sentence, or None for one output without variants
+    :return: a dict number of processes -> whether its files are identical to those of the first number
+    """
+    out_dir = tempfile.mkdtemp()
+    try:
+        outputs = dict()
+        for num_processes in process_counts:
+            variants = [None] if num_variants is None else range(num_variants)
+            out_filenames = [os.path.join(out_dir, str(num_processes), f"{lang}_{variant}.conllu") for variant in variants]
+            parallel_replacement(
+                lang=lang,
+                sents=sents,
+                trees=None,
+                morphdict=morphdict,
+                synt_patterns=synt_patterns,
+                upos_filter=upos_filter,
+                num_processes=num_processes,
+                num_variants=num_variants,
+                out_filenames=out_filenames,
+                seed=seed)
+            outputs[num_processes] = []
+            for out_filename in out_filenames:
+                with open(out_filename, 'rb') as f:
+                    outputs[num_processes].append(f.read())
+    finally:
+        shutil.rmtree(out_dir)
+    results = {num_processes: output == outputs[process_counts[0]] for num_processes, output in outputs.items()}
+    print(lang, 'num_variants', num_variants, 'identical output per number of processes:', results)
+    return results
+
+
+def check_pattern_build_paths(filenames, upos_filter=None, pattern_config=dict(), patterns_class=None):
+    """Checks that the pattern index of treebank files is the same whether it is built 
+    from TokenTrees (as in build_spud.ipynb) or from a CompactTreebank (as in main).
+
+    The matches drawn with a seed depend on the order of the vocabularies and buckets 
+    of the index, so both build paths (and a cached index of either) have to give the same index.
+
+    :param filenames: the treebank files
+    :param upos_filter: a list of upos to filter on
+    :param pattern_config: a pattern config, see pattern_configs
+    :param patterns_class: the class of the patterns, SyntacticPatterns (default) or SyntacticPatternsPOSOnly
+    :return: whether the two indexes are identical
+    """
+    patterns_class = patterns_class or SyntacticPatterns
+    trees = [tree for filename in filenames for tree in load_ud_treebank(filename, verbose=False)[1]]
+    treebank = CompactTreebank.concatenate([load_ud_treebank(filename, verbose=False, compact=True) for filename in filenames])
+    indexes = [
+        patterns_class(source, upos_filter=upos_filter, verbose=False, pattern_config=pattern_config).index() 
+        for source in [trees, treebank]]
+    identical = all(
+        indexes[0][name] == indexes[1][name] if name in pattern_vocabs else np.array_equal(indexes[0][name], indexes[1][name])
+        for name in pattern_vocabs + pattern_arrays)
+    print(patterns_class.__name__, 'identical index from trees and from a compact treebank:', identical)
+    return identical
+
+
+def write_synthetic_treebank(filename, num_sents=300, seed=0):
+    """Writes a small random treebank with German-like features to a CoNLL-U file, 
+    so the checks can run without the corpora.
+
+    Every sentence is a random tree of NOUN, VERB, ADJ and DET tokens. Some ADJ 
+    tokens have Degree=Pos and some have no Degree.
+
+    :param filename: the CoNLL-U file
+    :param num_sents: the number of sentences
+    :param seed: the seed of the treebank
+    """
+    rng = random.Random(seed)
+    deprels = {'NOUN': ['nsubj', 'obj', 'obl'], 'VERB': ['conj', 'ccomp'], 'ADJ': ['amod'], 'DET': ['det']}
+    with open(filename, 'w') as f:
+        for k in range(num_sents):
+            f.write(f"# sent_id = synthetic-{k}\n")
+            for i in range(1, rng.randint(3, 12) + 1):
+                upos = 'VERB' if i == 1 else rng.choice(['NOUN', 'NOUN', 'VERB', 'ADJ', 'DET'])
+                head = 0 if i == 1 else rng.randint(1, i - 1)
+                deprel = 'root' if i == 1 else rng.choice(deprels[upos])
+                lemma = f"{upos.lower()}{rng.randrange(30)}"
+                feats = {'Number': rng.choice(['Sing', 'Plur'])}
+                if upos in ['NOUN', 'ADJ', 'DET']:
+                    feats['Case'] = rng.choice(['Nom', 'Acc', 'Dat'])
+                if upos == 'ADJ' and rng.random() < 0.5:
+                    feats['Degree'] = 'Pos'
+                if upos == 'VERB':
+                    feats['VerbForm'] = 'Fin'
+                feats = '|'.join(f"{feat}={value}" for feat, value in sorted(feats.items()))
+                f.write(f"{i}\t{lemma}{rng.choice(['', 'e', 'en'])}\t{lemma}\t{upos}\t_\t{feats}\t{head}\t{deprel}\t_\t_\n")
+            f.write("\n")
+
+
+def synthetic_morphdict(sents, seed=0):
+    """Builds a German morphdict with random entries for the lemmas of a treebank, 
+    so the checks can run without the lexicon pickles.
+
+    An ADJ lemma only has Degree=Pos entries for Case=Nom, and two entries without 
+    Degree for every Number and Case. So ADJ tokens with Degree=Pos and another case 
+    need the ADJ fallback of GermanMorphDict, and the most frequent form of Case=Nom 
+    changes if the fallback changes the lexicon.
+
+    :param sents: a list of tokenlists, e.g. the synthetic treebank
+    :param seed: the seed of the entries
+    :return: a GermanMorphDict
+    """
+    rng = random.Random(seed)
+    lexicon = dict()
+    for sent in sents:
+        for token in sent:
+            upos, lemma = token['upos'], token['lemma']
+            if upos not in ['NOUN', 'VERB', 'ADJ'] or lemma in lexicon.get(upos, dict()):
+                continue
+            entries = []
+            for number, case in itertools.product(['Sing', 'Plur'], ['Nom', 'Acc', 'Dat']):
+                if upos == 'VERB':
+                    entries.append((lemma + rng.choice(['', 't', 'en']), {'Number': number}))
+                elif upos == 'NOUN':
+                    entries.append((lemma + rng.choice(['', 'e', 'en', 'es']), {'Number': number, 'Case': case}))
+                else:
+                    if case == 'Nom':
+                        entries.append((lemma + 'x', {'Number': number, 'Case': case, 'Degree': 'Pos'}))
+                    entries += [(lemma + 'y', {'Number': number, 'Case': case})] * 2
+            lexicon.setdefault(upos, dict())[lemma] = entries
+    # the lexicon is set directly instead of being prepared from the UDLexicons files
+    morphdict = GermanMorphDict.__new__(GermanMorphDict)
+    morphdict.upos2lemma2ufeatdictandform = lexicon
+    morphdict.num_entries = sum(len(entries) for lemma2entries in lexicon.values() for entries in lemma2entries.values())
+    morphdict.upos_filter = None
+    morphdict.adj_suffixes = ["er", "em", "en", "e", "es"]
+    return morphdict
+
+
+if __name__ == '__main__':
+    # python src/check_reproducibility.py [lang] [cutoff], or 
+    # python src/check_reproducibility.py synthetic, which runs on a synthetic treebank and lexicon
+    # German has the ADJ fallback that adds Degree=Pos, so it is the default
+    lang = sys.argv[1] if len(sys.argv) > 1 else 'de'
+    cutoff = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    upos_filter = ["NOUN", "PROPN", "VERB", "ADJ"]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if lang == 'synthetic':
+            lang = 'de'
+            filenames = [os.path.join(tmp_dir, 'synthetic.conllu')]
+            write_synthetic_treebank(filenames[0])
+            treebank = load_ud_treebank(filenames[0], verbose=False, compact=True)
+            morphdict = synthetic_morphdict(load_ud_treebank(filenames[0], verbose=False, no_trees=True))
+            synt_patterns = SyntacticPatterns(treebank, upos_filter=upos_filter, pattern_config=pattern_configs[lang])
+        else:
+            filenames = tb_paths[lang]["dev"]
+            treebank = load_ud_treebank(filenames[0], cache_dir=tb_cache_dir, compact=True)
+            morphdict = load_morphdict_from_pickle(lang)
+            synt_patterns = load_syntactic_patterns(
+                filenames,
+                pattern_cache_dir,
+                upos_filter=upos_filter,
+                pattern_config=pattern_configs[lang],
+                treebank=treebank)
+        # without variants (as in main of generate_data_multiprocess) and with variants (as in build_spud.ipynb)
+        same_output = all(
+            all(check_seeded_replacement(lang, treebank[:cutoff], morphdict, synt_patterns, upos_filter=upos_filter, num_variants=num_variants).values())
+            for num_variants in [None, 2])
+        same_index = all(
+            check_pattern_build_paths(filenames, upos_filter=upos_filter, pattern_config=pattern_configs[lang], patterns_class=patterns_class)
+            for patterns_class in [SyntacticPatterns, SyntacticPatternsPOSOnly])
+    finally:
+        shutil.rmtree(tmp_dir)
+    sys.exit(0 if same_output and same_index else 1)
@@ -0,0 +1,292 @@
+import numpy as np
+from conllu import Metadata, Token, TokenList
+from conllu.parser import (
+    DEFAULT_FIELDS, parse_dict_value, parse_id_value, parse_nullable_value, parse_paired_list_value,
+)
+from conllu.serializer import serialize_field
+
+# fields that are stored as ids into a vocabulary of their serialized values,
+# together with the function that turns a serialized value back into a python value
+vocab_fields = {
+    "form": lambda value: value,
+    "lemma": lambda value: value,
+    "upos": lambda value: value,
+    "xpos": parse_nullable_value,
+    "feats": parse_dict_value,
+    "deprel": lambda value: value,
+    "deps": parse_paired_list_value,
+    "misc": parse_dict_value,
+}
+
+# per-sentence arrays, everything else is either per token or a vocabulary
+sentence_level_arrays = ['sent_offsets', 'meta_offsets']
+metadata_arrays = ['meta_key', 'meta_is_none', 'meta_value_blob', 'meta_value_offsets']
+
+
+def encode_strings(strings):
+    """Encodes a list of strings as a utf-8 blob and an array of offsets into it."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def decode_strings(blob, offsets):
+    """Inverse of encode_strings."""
+    data = bytes(blob)
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def compile_treebank(dep_sents):
+    """Turns a list of tokenlists into a dict of flat numpy columns.
+
+    Every token field except id and head is stored as an int32 id into a
+    vocabulary of the serialized field values. Integer ids and heads are
+    stored directly (non-integer ids like '8.1' are stored as negative ids
+    into an extra vocabulary, missing heads as -1).
+
+    :param dep_sents: a list of tokenlists with the default CoNLL-U fields
+    :return: a dict of numpy arrays
+    """
+    vocabs = {field: dict() for field in vocab_fields}
+    columns = {field: [] for field in vocab_fields}
+    extra_ids = dict()
+    ids = []
+    heads = []
+    sent_offsets = [0]
+    meta_offsets = [0]
+    meta_keys = dict()
+    meta_key_ids = []
+    meta_values = []
+    meta_is_none = []
+
+    for dep_sent in dep_sents:
+        for tok in dep_sent:
+            if tuple(tok.keys()) != DEFAULT_FIELDS:
+                raise ValueError('only treebanks with the default CoNLL-U fields can be compiled')
+            if isinstance(tok['id'], int):
+                ids.append(tok['id'])
+            else:
+                ids.append(-1 - extra_ids.setdefault(serialize_field(tok['id']), len(extra_ids)))
+            heads.append(-1 if tok['head'] is None else tok['head'])
+            for field, vocab in vocabs.items():
+                columns[field].append(vocab.setdefault(serialize_field(tok[field]), len(vocab)))
+        sent_offsets.append(len(ids))
+        for key, value in dep_sent.metadata.items():
+            meta_key_ids.append(meta_keys.setdefault(key, len(meta_keys)))
+            meta_values.append('' if value is None else value)
+            meta_is_none.append(value is None)
+        meta_offsets.append(len(meta_values))
+
+    arrays = {
+        'id': np.array(ids, dtype=np.int32),
+        'head': np.array(heads, dtype=np.int32),
+        'sent_offsets': np.array(sent_offsets, dtype=np.int64),
+        'meta_offsets': np.array(meta_offsets, dtype=np.int64),
+        'meta_key': np.array(meta_key_ids, dtype=np.int32),
+        'meta_is_none': np.array(meta_is_none, dtype=np.bool_),
+    }
+    arrays['meta_value_blob'], arrays['meta_value_offsets'] = encode_strings(meta_values)
+    arrays['meta_key_vocab_blob'], arrays['meta_key_vocab_offsets'] = encode_strings(list(meta_keys))
+    arrays['extra_id_vocab_blob'], arrays['extra_id_vocab_offsets'] = encode_strings(list(extra_ids))
+    for field in vocab_fields:
+        arrays[field] = np.array(columns[field], dtype=np.int32)
+        arrays[field + '_vocab_blob'], arrays[field + '_vocab_offsets'] = encode_strings(list(vocabs[field]))
+    return arrays
+
+
+class CompactTreebank():
+    def __init__(self, arrays, vocab_cache=None):
+        """A treebank stored as flat numpy columns (see compile_treebank).
+
+        Tokens are integer-coded: upos, deprel, feats etc. are ids into
+        per-field vocabularies, heads and ids are int32 arrays, and
+        sent_offsets[i]:sent_offsets[i+1] is the token range of sentence i.
+        Sentences are only turned into tokenlists when they are accessed.
+
+        :param arrays: a dict of numpy arrays, e.g. from compile_treebank or a memory-mapped cache file
+        :param vocab_cache: decoded vocabularies to share with other views on the same arrays
+        """
+        self.arrays = arrays
+        self.sent_offsets = arrays['sent_offsets']
+        self.ids = arrays['id']
+        self.heads = arrays['head']
+        self.vocab_cache = dict() if vocab_cache is None else vocab_cache
+
+    @classmethod
+    def from_sents(cls, dep_sents):
+        """Compiles a list of tokenlists into a CompactTreebank."""
+        return cls(compile_treebank(dep_sents))
+
+    def strings(self, field):
+        """Returns the vocabulary of a field as a list of serialized strings, indexed by id."""
+        key = ('strings', field)
+        if key not in self.vocab_cache:
+            self.vocab_cache[key] = decode_strings(self.arrays[field + '_vocab_blob'], self.arrays[field + '_vocab_offsets'])
+        return self.vocab_cache[key]
+
+    def vocab(self, field):
+        """Returns the vocabulary of a field as a list of parsed values, indexed by id.
+
+        The values are shared between tokens, so don't edit them in place.
+        """
+        key = ('values', field)
+        if key not in self.vocab_cache:
+            if field == 'extra_id':
+                self.vocab_cache[key] = [parse_id_value(v) for v in self.strings(field)]
+            elif field == 'meta_key':
+                self.vocab_cache[key] = self.strings(field)
+            else:
+                self.vocab_cache[key] = [vocab_fields[field](v) for v in self.strings(field)]
+        return self.vocab_cache[key]
+
+    def vocab_ids(self, field):
+        """Returns a dict serialized value -> id for the vocabulary of a field."""
+        key = ('ids', field)
+        if key not in self.vocab_cache:
+            self.vocab_cache[key] = {value: i for i, value in enumerate(self.strings(field))}
+        return self.vocab_cache[key]
+
+    def __len__(self):
+        """Returns the number of sentences."""
+        return len(self.sent_offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return int(self.sent_offsets[-1] - self.sent_offsets[0])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.sentence(i)
+
+    def __getitem__(self, key):
+        """Returns a tokenlist for an int, and a CompactTreebank view for a slice."""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('CompactTreebank only supports slices with step 1')
+            return self.slice(start, max(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('sentence index out of range')
+        return self.sentence(key)
+
+    def slice(self, start, stop):
+        """Returns a view on the sentences start:stop. Token columns and vocabularies are not copied."""
+        tok_start, tok_stop = int(self.sent_offsets[start]), int(self.sent_offsets[stop])
+        meta_start, meta_stop = int(self.arrays['meta_offsets'][start]), int(self.arrays['meta_offsets'][stop])
+        arrays = dict(self.arrays)
+        arrays['sent_offsets'] = self.sent_offsets[start:stop + 1] - tok_start
+        arrays['meta_offsets'] = self.arrays['meta_offsets'][start:stop + 1] - meta_start
+        arrays['meta_key'] = self.arrays['meta_key'][meta_start:meta_stop]
+        arrays['meta_is_none'] = self.arrays['meta_is_none'][meta_start:meta_stop]
+        arrays['meta_value_offsets'] = self.arrays['meta_value_offsets'][meta_start:meta_stop + 1]
+        for field in ['id', 'head'] + list(vocab_fields):
+            arrays[field] = self.arrays[field][tok_start:tok_stop]
+        return CompactTreebank(arrays, vocab_cache=self.vocab_cache)
+
+    def token_range(self, i):
+        """Returns the (start, end) token positions of sentence i."""
+        return int(self.sent_offsets[i]), int(self.sent_offsets[i + 1])
+
+    def sentence(self, i):
+        """Decodes sentence i into a tokenlist.
+
+        Mutable values (feats, misc, deps) are copied, so the tokens can be
+        edited without affecting the treebank.
+        """
+        start, end = self.token_range(i)
+        vocabs = {field: self.vocab(field) for field in vocab_fields}
+        columns = {field: self.arrays[field][start:end].tolist() for field in vocab_fields}
+        extra_ids = self.vocab('extra_id')
+        tokens = []
+        for t, (tok_id, head) in enumerate(zip(self.ids[start:end].tolist(), self.heads[start:end].tolist())):
+            feats = vocabs['feats'][columns['feats'][t]]
+            deps = vocabs['deps'][columns['deps'][t]]
+            misc = vocabs['misc'][columns['misc'][t]]
+            tokens.append(Token([
+                ('id', tok_id if tok_id >= 0 else extra_ids[-1 - tok_id]),
+                ('form', vocabs['form'][columns['form'][t]]),
+                ('lemma', vocabs['lemma'][columns['lemma'][t]]),
+                ('upos', vocabs['upos'][columns['upos'][t]]),
+                ('xpos', vocabs['xpos'][columns['xpos'][t]]),
+                ('feats', None if feats is None else dict(feats)),
+                ('head', None if head < 0 else head),
+                ('deprel', vocabs['deprel'][columns['deprel'][t]]),
+                ('deps', list(deps) if isinstance(deps, list) else deps),
+                ('misc', None if misc is None else dict(misc)),
+            ]))
+        return TokenList(tokens, self.metadata(i), default_fields=DEFAULT_FIELDS)
+
+    def metadata(self, i):
+        """Decodes the metadata of sentence i."""
+        meta_keys = self.vocab('meta_key')
+        meta_start, meta_end = int(self.arrays['meta_offsets'][i]), int(self.arrays['meta_offsets'][i + 1])
+        value_offsets = self.arrays['meta_value_offsets']
+        blob = self.arrays['meta_value_blob']
+        metadata = Metadata()
+        for m in range(meta_start, meta_end):
+            key = meta_keys[self.arrays['meta_key'][m]]
+            if self.arrays['meta_is_none'][m]:
+                metadata[key] = None
+            else:
+                metadata[key] = bytes(blob[value_offsets[m]:value_offsets[m + 1]]).decode('utf-8')
+        return metadata
+
+    def to_sents(self, cutoff=None):
+        """Decodes the first cutoff (default: all) sentences into a list of tokenlists."""
+        num_sents = len(self) if cutoff is None else min(cutoff, len(self))
+        return [self.sentence(i) for i in range(num_sents)]
+
+    def serialize(self):
+        """Returns the whole treebank as a CoNLL-U string."""
+        return ''.join(dep_sent.serialize() for dep_sent in self)
+
+    @staticmethod
+    def concatenate(treebanks):
+        """Concatenates CompactTreebanks into a new one with merged vocabularies.
+
+        :param treebanks: a list of CompactTreebanks
+        :return: a CompactTreebank with the sentences of all treebanks, in order
+        """
+        merged_vocabs = {field: dict() for field in list(vocab_fields) + ['extra_id', 'meta_key']}
+        columns = {field: [] for field in list(vocab_fields) + ['id', 'meta_key']}
+        heads, meta_is_none, meta_values = [], [], []
+        sent_offsets, meta_offsets = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+        for tb in treebanks:
+            # translate the ids of each vocabulary into the merged vocabulary
+            remap = dict()
+            for field, merged in merged_vocabs.items():
+                remap[field] = np.array(
+                    [merged.setdefault(value, len(merged)) for value in tb.strings(field)], dtype=np.int32)
+            for field in vocab_fields:
+                columns[field].append(remap[field][tb.arrays[field]])
+            ids = np.array(tb.ids)
+            extra = ids < 0
+            ids[extra] = -1 - remap['extra_id'][-1 - ids[extra]]
+            columns['id'].append(ids)
+            heads.append(np.array(tb.heads))
+            columns['meta_key'].append(remap['meta_key'][tb.arrays['meta_key']])
+            meta_is_none.append(np.array(tb.arrays['meta_is_none']))
+            meta_values += [tb.metadata(i) for i in range(len(tb))]
+            sent_offsets.append(tb.sent_offsets[1:] - tb.sent_offsets[0] + sent_offsets[-1][-1])
+            meta_offsets.append(tb.arrays['meta_offsets'][1:] - tb.arrays['meta_offsets'][0] + meta_offsets[-1][-1])
+
+        arrays = {
+            'id': np.concatenate(columns['id']).astype(np.int32),
+            'head': np.concatenate(heads).astype(np.int32),
+            'sent_offsets': np.concatenate(sent_offsets).astype(np.int64),
+            'meta_offsets': np.concatenate(meta_offsets).astype(np.int64),
+            'meta_key': np.concatenate(columns['meta_key']).astype(np.int32),
+            'meta_is_none': np.concatenate(meta_is_none).astype(np.bool_),
+        }
+        values = ['' if value is None else value for metadata in meta_values for value in metadata.values()]
+        arrays['meta_value_blob'], arrays['meta_value_offsets'] = encode_strings(values)
+        for field, merged in merged_vocabs.items():
+            if field in vocab_fields:
+                arrays[field] = np.concatenate(columns[field]).astype(np.int32)
+            arrays[field + '_vocab_blob'], arrays[field + '_vocab_offsets'] = encode_strings(list(merged))
+        return CompactTreebank(arrays)
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+def token_coverage(treebank, synt_patterns, morphdict=None, verbose=False):
+    """Computes for every token of a treebank whether it could be replaced.
+
+    The tokens are the tree tokens with an upos in the upos filter of the patterns.
+    For each token, the candidates are the entries of the bucket of its signature
+    with another lemma. The counts are computed with array operations over the
+    bucket and lemma group arrays of the patterns (see SyntacticPatterns.build_lemma_groups).
+
+    With a morphdict, the candidates are also counted by whether the lexicon has
+    a form of their lemma with the upos and the required ufeats of the token
+    (see MorphDict.inflectable_lemmas_for_token), i.e. whether the replacer
+    can inflect them for the token. The tokens are grouped by upos and required
+    ufeats, and the counts are computed once per group from the inflectable
+    lemma ids of the feature index (see MorphDict.inflectable_lemma_ids).
+
+    :param treebank: a CompactTreebank
+    :param synt_patterns: a SyntacticPatterns (or SyntacticPatternsPOSOnly) object
+    :param morphdict: a MorphDict object, or None
+    :param verbose: whether to print progress information
+    :return: a dict of arrays with one entry per token:
+        'position' (of the token in the columns of the treebank), 'upos', 'deprel' (strings),
+        'has_signature' (the signature of the token occurs in the patterns),
+        'num_candidates' (bucket entries with another lemma),
+        'num_lexicon_candidates' (lemma groups of these entries with a form in the lexicon
+        for the required ufeats of the token, only with a morphdict)
+    """
+    print('find token signatures') if verbose else None
+    positions, signatures = synt_patterns.compact_signatures(treebank, upos_filter=synt_patterns.upos_filter, verbose=verbose)
+    sig_ids = np.array([synt_patterns.signature_ids.get(signature, -1) for signature in signatures], dtype=np.int64)
+    has_signature = sig_ids >= 0
+    known_sig_ids = np.where(has_signature, sig_ids, 0)
+
+    # lemma ids of the tokens in the vocabulary of the patterns (-1 if unknown)
+    lemma_map = np.array([synt_patterns.lemma_ids.get(lemma, -1) for lemma in treebank.vocab('lemma')], dtype=np.int64)
+    lemma_ids = lemma_map[treebank.arrays['lemma'][positions]] if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+
+    # the lemma group of each token in its bucket: groups are sorted by (signature, lemma)
+    print('find lemma groups') if verbose else None
+    num_lemmas = len(synt_patterns.lemmas) + 1
+    group_sig_ids = np.repeat(np.arange(len(synt_patterns.signatures), dtype=np.int64), np.diff(synt_patterns.bucket_group_offsets))
+    group_keys = group_sig_ids * num_lemmas + synt_patterns.group_lemma_ids
+    token_keys = known_sig_ids * num_lemmas + lemma_ids
+    groups = np.minimum(np.searchsorted(group_keys, token_keys), max(len(group_keys) - 1, 0))
+    in_own_group = has_signature & (lemma_ids >= 0) & (len(group_keys) > 0)
+    if len(group_keys) > 0:
+        in_own_group &= group_keys[groups] == token_keys
+    group_sizes = np.diff(synt_patterns.group_starts)
+    own_group_sizes = np.where(in_own_group, group_sizes[groups] if len(group_sizes) > 0 else 0, 0)
+
+    bucket_sizes = np.diff(synt_patterns.bucket_offsets)
+    num_candidates = np.where(has_signature, bucket_sizes[known_sig_ids] - own_group_sizes, 0)
+
+    upos_vocab, deprel_vocab = treebank.vocab('upos'), treebank.vocab('deprel')
+    coverage = {
+        'position': positions,
+        'upos': np.array([upos_vocab[u] for u in treebank.arrays['upos'][positions].tolist()], dtype=object),
+        'deprel': np.array([deprel_vocab[d] for d in treebank.arrays['deprel'][positions].tolist()], dtype=object),
+        'has_signature': has_signature,
+        'num_candidates': num_candidates,
+    }
+
+    if morphdict is not None:
+        print('match lemma groups with the lexicon') if verbose else None
+        # the tokens are grouped by upos and the ufeats every form found by the lookup has,
+        # since these determine the lemmas the lookup can find forms of (see MorphDict.inflectable_lemmas_for_token)
+        feats_vocab = treebank.vocab('feats')
+        upos_feats_ids, token_upos_feats = np.unique(
+            np.stack([treebank.arrays['upos'][positions], treebank.arrays['feats'][positions]], axis=1),
+            axis=0, return_inverse=True)
+        token_upos_feats = token_upos_feats.reshape(-1)
+        key_ids = dict()
+        upos_feats_keys = []
+        for upos_id, feats_id in upos_feats_ids.tolist():
+            token = {'upos': upos_vocab[upos_id], 'feats': feats_vocab[feats_id]}
+            key = (token['upos'], tuple(sorted(morphdict.required_ufeats(token).items())))
+            upos_feats_keys.append(key_ids.setdefault(key, len(key_ids)))
+        token_keys = np.array(upos_feats_keys, dtype=np.int64)[token_upos_feats] if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+
+        # the id of every lemma of the patterns in the compiled lexicon of a upos (-1 if it is not in the lexicon), 
+        # mapped once per upos
+        lexicon_lemma_ids = dict()
+        num_lexicon_candidates = np.zeros(len(positions), dtype=np.int64)
+        for (upos, ufeats), key_id in key_ids.items():
+            tokens = np.flatnonzero((token_keys == key_id) & has_signature)
+            if len(tokens) == 0:
+                continue
+            if upos not in lexicon_lemma_ids:
+                lexicon = morphdict.compiled_lexicon(upos)
+                lemma_ids = [None] * len(synt_patterns.lemmas) if lexicon is None else [lexicon.lemma_id(lemma) for lemma in synt_patterns.lemmas]
+                lexicon_lemma_ids[upos] = np.array([-1 if lemma_id is None else lemma_id for lemma_id in lemma_ids], dtype=np.int64)
+            lemma_in_lexicon = np.isin(lexicon_lemma_ids[upos], morphdict.inflectable_lemma_ids(upos, dict(ufeats)))
+            group_in_lexicon = lemma_in_lexicon[synt_patterns.group_lemma_ids].astype(np.int64)
+            # number of groups in the lexicon per bucket, without the own group of the token
+            cum_in_lexicon = np.zeros(len(group_in_lexicon) + 1, dtype=np.int64)
+            cum_in_lexicon[1:] = np.cumsum(group_in_lexicon)
+            bucket_in_lexicon = cum_in_lexicon[synt_patterns.bucket_group_offsets[1:]] - cum_in_lexicon[synt_patterns.bucket_group_offsets[:-1]]
+            own_group_in_lexicon = np.where(in_own_group[tokens], group_in_lexicon[groups[tokens]], 0)
+            num_lexicon_candidates[tokens] = bucket_in_lexicon[known_sig_ids[tokens]] - own_group_in_lexicon
+        coverage['num_lexicon_candidates'] = num_lexicon_candidates
+    return coverage
+
+
+def coverage_summary(coverage, by='upos'):
+    """Summarizes a token coverage per upos or per deprel.
+
+    Output is a dict, which can be turned into a DataFrame by
+    pd.DataFrame(coverage_summary(coverage)) or similar.
+
+    :param coverage: a token coverage, as returned by token_coverage
+    :param by: 'upos' or 'deprel'
+    :return: a dict upos/deprel -> dict of the number of tokens, the fraction of tokens
+        with a pattern match (and with a lexicon candidate), and the mean number of candidates
+    """
+    keys, inverse = np.unique(coverage[by].astype(str), return_inverse=True)
+    num_tokens = np.bincount(inverse, minlength=len(keys))
+    with_match = np.bincount(inverse, weights=coverage['num_candidates'] > 0, minlength=len(keys))
+    candidates = np.bincount(inverse, weights=coverage['num_candidates'], minlength=len(keys))
+    if 'num_lexicon_candidates' in coverage:
+        with_lexicon = np.bincount(inverse, weights=coverage['num_lexicon_candidates'] > 0, minlength=len(keys))
+    res_dict = dict()
+    for i, key in enumerate(keys.tolist()):
+        res_dict_for_key = {
+            'No. of tokens': int(num_tokens[i]),
+            'with pattern match': with_match[i] / num_tokens[i],
+            'mean No. of candidates': candidates[i] / num_tokens[i],
+        }
+        if 'num_lexicon_candidates' in coverage:
+            res_dict_for_key['with lexicon candidate'] = with_lexicon[i] / num_tokens[i]
+        res_dict[key] = res_dict_for_key
+    return res_dict
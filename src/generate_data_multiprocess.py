@@ -13,12 +13,15 @@ from morph_dict_tools.udlex_arabic import *
 from morph_dict_tools.udlex_russian import *
 from replacement import *
 
+import gc
 import multiprocessing as mp
-from multiprocessing import Process
-import copy
+import resource
+import shutil
 
 tb_path_mod = "data/ud210/modified-ud-treebanks/"
 tb_path_orig = "data/ud210/ud-treebanks-v2.10/"
+tb_cache_dir = "data/cache/treebanks/"
+pattern_cache_dir = "data/cache/patterns/"
 tb_paths = {
     "ar": {
         "train": [tb_path_mod + "UD_Arabic-PADT/ar_padt-ud-train.conllu"],
@@ -44,25 +47,92 @@ tb_paths = {
     }
 
 
+def memory_usage():
+    """The memory usage of the current process, in MB.
+
+    Besides the peak RSS, reports the proportional set size (shared pages are 
+    divided by the number of processes sharing them) and the private memory, 
+    if /proc/self/smaps_rollup is available (Linux). 
+
+    :return: a dict with the keys 'max_rss', and 'pss' and 'private' if available
+    """
+    # ru_maxrss is in KB on Linux
+    usage = {'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if os.path.exists('/proc/self/smaps_rollup'):
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        usage['pss'] = int(fields['Pss'].split()[0]) / 1024
+        usage['private'] = sum(int(fields[k].split()[0]) for k in ['Private_Clean', 'Private_Dirty']) / 1024
+    return usage
+
+
 class ReplacerProcessHelper():
-    def __init__(self, lang, synt_patterns, morphdict, upos_filter=None): 
-        self.replacer = make_replacer(lang, synt_patterns, morphdict, upos_filter=upos_filter)
+    def __init__(self, lang, synt_patterns, morphdict, upos_filter=None, seed=None): 
+        self.replacer = make_replacer(lang, synt_patterns, morphdict, upos_filter=upos_filter, seed=seed)
         self.lang = lang
 
-    def fwd(self, sents, trees, slice_number):
-        new_sents, _, _, _ = self.replacer.replace_tokens_in_sentences(sents, trees)
-        print('Created ', len(new_sents), ' new sentences')
+    def fwd(self, sents, trees, slice_number, return_dict=None, num_variants=None, run_id=0, sentence_offset=0):
+        """Replace tokens in a slice and save the new sentences to a tmp file.
+
+        :param sents: a list of tokenlists, or a CompactTreebank
+        :param trees: a list of tokentrees, or None (e.g. for a CompactTreebank)
+        :param slice_number: the number of the slice, used for the file name
+        :param return_dict: if not None, the memory usage of the process is stored 
+            in it under slice_number (see memory_usage)
+        :param num_variants: if not None, the number of variants to draw per sentence. 
+            Each variant is saved to its own tmp file (see slice_filename)
+        :param run_id: the run id of the (first) variant, used with a seed
+        :param sentence_offset: the index of the first sentence of the slice in the treebank, used with a seed
+        """
+        new_sents, _, _, _ = self.replacer.replace_tokens_in_sentences(
+            sents, trees, num_variants=num_variants, run_id=run_id, sentence_offset=sentence_offset)
+        variants = [new_sents] if num_variants is None else new_sents
+        print('Created ', len(variants[0]), ' new sentences in ', len(variants), ' variants')
         # return_dict[slice_number] = new_sents
 
         print('Saving sentences to conllu file')
-        filename = f"_{self.lang}_sents_slice_{slice_number}.conllu"
-        with open(filename, 'w') as f:
-            for sent in map(lambda x:x.serialize(), new_sents):
-                f.write(sent)
+        for variant, variant_sents in enumerate(variants):
+            filename = slice_filename(self.lang, slice_number, None if num_variants is None else variant)
+            serialize_sents_to_conllu_file(variant_sents, filename)
         del self.replacer
+        if return_dict is not None:
+            return_dict[slice_number] = memory_usage()
         print('Done with slice ', slice_number)
 
-def parallel_replacement(lang=None, sents=None, trees=None, morphdict=None, synt_patterns=None, upos_filter=None, num_processes=4):
+def slice_filename(lang, slice_number, variant=None):
+    """The name of the tmp file of a slice (and variant) in parallel_replacement."""
+    if variant is None:
+        return f"_{lang}_sents_slice_{slice_number}.conllu"
+    return f"_{lang}_sents_slice_{slice_number}_variant_{variant}.conllu"
+
+def parallel_replacement(lang=None, sents=None, trees=None, morphdict=None, synt_patterns=None, upos_filter=None, num_processes=4, 
+                         num_variants=None, out_filenames=None, seed=None, run_id=0):
+    """Replace tokens in a treebank with several processes.
+
+    The treebank is split into one slice per process. Each process writes its new 
+    sentences to a tmp file, and the tmp files are merged at the end.
+
+    With a seed, every sentence is replaced with its own random number generator, 
+    seeded with (seed, run id, index of the sentence in the treebank). The output is 
+    then the same for any number of processes. Without a seed, the random module is 
+    used, which is seeded anew in every forked process.
+
+    :param lang: the language, see make_replacer
+    :param sents: a list of tokenlists, or a CompactTreebank
+    :param trees: a list of tokentrees, or None
+    :param morphdict: a MorphDict object
+    :param synt_patterns: a SyntacticPatterns object
+    :param upos_filter: a list of upos to replace
+    :param num_processes: the number of processes
+    :param num_variants: if not None, the number of variants to draw per sentence, in one pass 
+        (the signatures of each sentence are found only once)
+    :param out_filenames: if not None, a list of CoNLL-U files, one per variant (one for no variants). 
+        The tmp files are then copied into these files as they are, without parsing them again
+    :param seed: the global seed, or None
+    :param run_id: the run id of the (first) variant, used with a seed
+    :return: the list of new sentences, or with num_variants a list of these per variant. 
+        With out_filenames, out_filenames
+    """
     processes = []
     tb_size = len(sents)
     print('num_processes', num_processes)
@@ -74,40 +144,70 @@ def parallel_replacement(lang=None, sents=None, trees=None, morphdict=None, synt
 
     manager = mp.Manager()
     return_dict = manager.dict()
-    print('build and start processes')
-    for i in range(num_processes):
-        if start == tb_size:
-            break
-        end = min((i + 1) * slice_size, tb_size)
-        print('i', i, 'start', start, 'end', end)
-
-        pats = copy.deepcopy(synt_patterns)
-        md = copy.deepcopy(morphdict)
-        up_f = copy.deepcopy(upos_filter)
-        rph = ReplacerProcessHelper(lang, pats, md, upos_filter=up_f)
+    # compile the lexicon of the morphdict into flat arrays here, so the processes share them
+    # instead of each building its own copy on first use
+    if morphdict is not None:
+        print('compile lookup structures of the morphdict')
+        morphdict.compile_lookup_structures(upos_filter=upos_filter)
+    # the processes are forked, so they share the patterns and the morphdict of this 
+    # process copy-on-write instead of getting copies. Freezing the gc keeps the 
+    # collector from writing to (and thus copying) the pages of these objects
+    ctx = mp.get_context('fork')
+    gc.collect()
+    gc.freeze()
+    # unfreeze also if a process fails to start or join, e.g. in a notebook session
+    try:
+        print('build and start processes')
+        for i in range(num_processes):
+            if start == tb_size:
+                break
+            end = min((i + 1) * slice_size, tb_size)
+            print('i', i, 'start', start, 'end', end)
+
+            rph = ReplacerProcessHelper(lang, synt_patterns, morphdict, upos_filter=upos_filter, seed=seed)
  
-        p = Process(target=rph.fwd, args=(sents[start:end], trees[start:end], i))
-
-        processes.append(p)
-        p.start()
-        start = end
-    #print('start processes')
-    #for p in processes:
-    #    p.start()
-    print('join processes')
-    for p_n,p in enumerate(processes):
-        print('join process', p_n)
-        p.join()
+            slice_trees = None if trees is None else trees[start:end]
+            p = ctx.Process(target=rph.fwd, args=(sents[start:end], slice_trees, i, return_dict, num_variants, run_id, start))
+
+            processes.append(p)
+            p.start()
+            start = end
+        print('join processes')
+        for p_n,p in enumerate(processes):
+            print('join process', p_n)
+            p.join()
+    finally:
+        gc.unfreeze()
+    print('memory usage (MB) of the main process', memory_usage())
+    for i in sorted(return_dict.keys()):
+        print('memory usage (MB) of process', i, return_dict[i])
     
-    print('done creating. Now reloading and merging')
-    new_sents = []
-    for i in range(num_processes):
-        print(i)
-        new_sents += load_ud_treebank(f"_{lang}_sents_slice_{i}.conllu", no_trees=True)
+    variants = [None] if num_variants is None else list(range(num_variants))
+    num_slices = len(processes)
+    if out_filenames is not None:
+        print('done creating. Now merging into the output files')
+        for variant, out_filename in zip(variants, out_filenames):
+            os.makedirs(os.path.dirname(out_filename) or '.', exist_ok=True)
+            with open(out_filename, 'w') as out_f:
+                for i in range(num_slices):
+                    with open(slice_filename(lang, i, variant)) as f:
+                        shutil.copyfileobj(f, out_f)
+        result = out_filenames
+    else:
+        print('done creating. Now reloading and merging')
+        result = []
+        for variant in variants:
+            new_sents = []
+            for i in range(num_slices):
+                print(i)
+                new_sents += load_ud_treebank(slice_filename(lang, i, variant), no_trees=True)
+            result.append(new_sents)
+        result = result[0] if num_variants is None else result
     print('remove tmp files')
-    for i in range(num_processes):
-        os.remove(f"_{lang}_sents_slice_{i}.conllu")
-    return new_sents
+    for variant in variants:
+        for i in range(num_slices):
+            os.remove(slice_filename(lang, i, variant))
+    return result
 
 
 def main():
@@ -118,24 +218,14 @@ def main():
     treebanks = dict() 
     for lang in langs:
         print('load treebanks for ', lang)
+        # compact treebanks: sentences are only decoded into tokenlists when they are replaced
         treebanks[lang] = {
-            "train": load_ud_treebank(tb_paths[lang]["train"][0]),
-            "dev": load_ud_treebank(tb_paths[lang]["dev"][0]),
-            "test": load_ud_treebank(tb_paths[lang]["test"][0])
+            "train": load_ud_treebank(tb_paths[lang]["train"][0], cache_dir=tb_cache_dir, compact=True),
+            "dev": load_ud_treebank(tb_paths[lang]["dev"][0], cache_dir=tb_cache_dir, compact=True),
+            "test": load_ud_treebank(tb_paths[lang]["test"][0], cache_dir=tb_cache_dir, compact=True)
         }
     upos_filter = ["NOUN", "PROPN", "VERB", "ADJ"]
 
-    # load syntactic patterns for all languages
-    synt_patterns = {lang:dict() for lang in langs}
-    for lang in langs:
-        print('load syntactic patterns for ', lang)
-        pattern_config = pattern_configs[lang]
-        # train
-        synt_patterns[lang]["train"] = SyntacticPatterns(treebanks[lang]["train"][1], upos_filter=upos_filter, pattern_config=pattern_config)
-        # dev/test
-        dev_test_trees = treebanks[lang]["dev"][1] + treebanks[lang]["test"][1]
-        synt_patterns[lang]["dev+test"] = SyntacticPatterns(dev_test_trees, upos_filter=upos_filter, pattern_config=pattern_config)
-
     # optimized for 64GB RAM, 32 swap
     # first for train set, second for dev+test
     lang_to_num_processes={
@@ -145,30 +235,65 @@ def main():
         "fr": [4,2],
         "ru": [5,3],
     }
+
+    # load syntactic patterns for all languages
+    synt_patterns = {lang:dict() for lang in langs}
+    for lang in langs:
+        print('load syntactic patterns for ', lang)
+        pattern_config = pattern_configs[lang]
+        # the pattern indexes are cached, and only rebuilt when the treebanks or the config change
+        # train
+        synt_patterns[lang]["train"] = load_syntactic_patterns(
+            tb_paths[lang]["train"], 
+            pattern_cache_dir, 
+            upos_filter=upos_filter, 
+            pattern_config=pattern_config, 
+            treebank=treebanks[lang]["train"], 
+            num_processes=lang_to_num_processes[lang][0])
+        # dev/test: one index per file, merged
+        synt_patterns[lang]["dev+test"] = load_syntactic_patterns(
+            tb_paths[lang]["dev"], 
+            pattern_cache_dir, 
+            upos_filter=upos_filter, 
+            pattern_config=pattern_config, 
+            treebank=treebanks[lang]["dev"], 
+            num_processes=lang_to_num_processes[lang][1])
+        synt_patterns[lang]["dev+test"].merge(load_syntactic_patterns(
+            tb_paths[lang]["test"], 
+            pattern_cache_dir, 
+            upos_filter=upos_filter, 
+            pattern_config=pattern_config, 
+            treebank=treebanks[lang]["test"], 
+            num_processes=lang_to_num_processes[lang][1]))
+
     cutoff=100000000
+    # the output does not depend on lang_to_num_processes, see parallel_replacement
+    seed=42
     out_dir = "out/upos-only/" #"out/ud/"
     for lang in langs:
         print('replace tokens in train', lang)
         new_sents = parallel_replacement(
             lang=lang,
-            sents=treebanks[lang]["train"][0][:cutoff], 
-            trees=treebanks[lang]["train"][1][:cutoff], 
+            sents=treebanks[lang]["train"][:cutoff], 
+            trees=None, 
             morphdict=morphdicts[lang], 
             synt_patterns=synt_patterns[lang]["train"], 
             upos_filter=upos_filter,
-            num_processes=lang_to_num_processes[lang][0])
+            num_processes=lang_to_num_processes[lang][0],
+            seed=seed)
         print('\nsave new treebank')
         serialize_sents_to_conllu_file(new_sents, f"{out_dir}{lang}_train.conllu")
 
         print('replace tokens in dev', lang)
         new_sents = parallel_replacement(
             lang=lang,
-            sents=treebanks[lang]["dev"][0][:cutoff],
-            trees=treebanks[lang]["dev"][1][:cutoff],
+            sents=treebanks[lang]["dev"][:cutoff],
+            trees=None,
             morphdict=morphdicts[lang],
             synt_patterns=synt_patterns[lang]["dev+test"],
             upos_filter=upos_filter,
-            num_processes=lang_to_num_processes[lang][1])
+            num_processes=lang_to_num_processes[lang][1],
+            seed=seed)
         print('\nsave new treebank')
         serialize_sents_to_conllu_file(new_sents, f"{out_dir}{lang}_dev.conllu")
 
@@ -33,13 +33,17 @@ class ArabicMorphDict(MorphDict):
         self.upos2lemma2ufeatdictandform = create_lexicon_dict_from_df(lex, verbose=verbose)
         del lex
     
+    def relaxable_feats(self, token):
+        """all of them, since the lookup returns the lemma itself"""
+        return set(token['feats'] or dict())
+
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
         targetufeats.pop('Definite', None)
-        forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+        forms = candidatesWithLemma.matching_forms(targetufeats)
         if len(forms)==0 and token["upos"] == "VERB":
             # drop aspect, Fin Verbform and Ind Mood
             targetufeats.pop("Aspect", None)
             targetufeats.pop("VerbForm") if targetufeats.get("VerbForm") == "Fin" else None
             targetufeats.pop("Mood") if targetufeats.get("Mood") == "Ind" else None
-            forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+            forms = candidatesWithLemma.matching_forms(targetufeats)
         return forms
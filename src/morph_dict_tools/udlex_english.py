@@ -123,6 +123,17 @@ class EnglishMorphDict(MorphDict):
         
 
 
+    def relaxable_feats(self, token):
+        """VerbForm=Fin, and Person and Number in the past tense, for verbs"""
+        feats = token['feats'] or dict()
+        relaxable = set()
+        if token['upos'] == "VERB":
+            if feats.get('VerbForm') == 'Fin':
+                relaxable.add('VerbForm')
+            if feats.get('Tense') == 'Past':
+                relaxable.update(['Person', 'Number'])
+        return relaxable
+
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
 
         upos = token['upos']
@@ -133,7 +144,7 @@ class EnglishMorphDict(MorphDict):
                 targetufeats.pop('Person', None)
                 targetufeats.pop('Number', None)
         
-        forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+        forms = candidatesWithLemma.matching_forms(targetufeats)
         return forms
 
     def word_starts_with_consonant(self, word):
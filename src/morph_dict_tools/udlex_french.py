@@ -66,5 +66,5 @@ class FrenchMorphDict(MorphDict):
     
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
         
-        forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+        forms = candidatesWithLemma.matching_forms(targetufeats)
         return forms
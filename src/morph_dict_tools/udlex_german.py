@@ -52,6 +52,9 @@ def prepareGermanDict(upos_filter=None, verbose=False):
     return german
 
 class GermanMorphDict(MorphDict):
+    # the ADJ fallback of lang_specific_lookup adds Degree=Pos
+    default_features = [("Degree", "Pos")]
+
     def __init__(self, upos_filter=None, verbose=True):
 
         # prepare the lexicon df
@@ -66,6 +69,19 @@ class GermanMorphDict(MorphDict):
         self.upos2lemma2ufeatdictandform = create_lexicon_dict_from_df(lex, verbose=verbose)
         del lex
     
+    def relaxable_feats(self, token):
+        """Person for nouns, VerbForm=Fin for verbs, and Degree=Pos for adjectives 
+        (which the fallback adds to lexicon entries without Degree)"""
+        upos = token['upos']
+        feats = token['feats'] or dict()
+        if upos in ["NOUN","PROPN"]:
+            return {'Person'}
+        elif upos == "VERB" and feats.get('VerbForm') == 'Fin':
+            return {'VerbForm'}
+        elif upos == "ADJ" and feats.get('Degree') == 'Pos':
+            return {'Degree'}
+        return set()
+
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
 
         upos = token['upos']
@@ -74,14 +90,12 @@ class GermanMorphDict(MorphDict):
         elif upos == "VERB" and targetufeats.get('VerbForm') =='Fin':
             targetufeats.pop('VerbForm')
         
-        forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+        forms = candidatesWithLemma.matching_forms(targetufeats)
         if upos == "ADJ":
             if len(forms)== 0:
-                # Degree=Pos is sometimes missing in the morph lex. Therfore, we add it here
-                for form, ufeatdict in candidatesWithLemma:
-                    if "Degree" not in ufeatdict:
-                        ufeatdict["Degree"] = "Pos"
-                forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+                # Degree=Pos is sometimes missing in the morph lex. Therfore, we add it here 
+                # (to copies of the entries, so the result does not depend on earlier lookups)
+                forms = candidatesWithLemma.with_default_feature("Degree", "Pos").matching_forms(targetufeats)
             # filter those forms that have the same ending as the replaced form
             # positive / comp. / superlative should be detected by features
             old_ending = self.determine_adj_suffix(token['form'])
@@ -92,6 +106,10 @@ class GermanMorphDict(MorphDict):
                     forms = forms_with_same_ending
         return forms
 
+    def lang_specific_lookup_key(self, token):
+        """the suffix of the old form, for adjectives"""
+        return self.determine_adj_suffix(token['form']) if token['upos'] == "ADJ" else None
+
     def determine_adj_suffix(self, adjform):
         """Returns "e" if the adjform ends with "e", 
         otherwise the last two letters of the adjform."""
@@ -30,40 +30,58 @@ class RussianMorphDict(MorphDict):
         self.upos2lemma2ufeatdictandform = create_lexicon_dict_from_df(lex, verbose=verbose)
         del lex
 
+    def lang_specific_lookup_key(self, token):
+        """whether the old form is reflexive, for verbs"""
+        return token["form"][-2:] in self.refl_suffixes if token['upos'] == 'VERB' else None
+
+    def relaxable_feats(self, token):
+        """the features that the fallbacks of lang_specific_lookup drop"""
+        upos = token['upos']
+        feats = token['feats'] or dict()
+        relaxable = set()
+        if upos == 'PROPN':
+            relaxable.add('Animacy')
+        if upos in ['ADJ', 'ADV'] and feats.get('Degree') == 'Pos':
+            relaxable.add('Degree')
+        if upos == 'VERB':
+            # VerbForm=Fin, Aspect=Imp, Mood=Ind and Voice=Act
+            relaxable.update(k for k, v in [('VerbForm', 'Fin'), ('Aspect', 'Imp'), ('Mood', 'Ind'), ('Voice', 'Act')] if feats.get(k) == v)
+        return relaxable
+
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
         
             
-        forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+        forms = candidatesWithLemma.matching_forms(targetufeats)
         if len(forms) == 0 and token['upos']=='PROPN':
             targetufeats.pop('Animacy', None)
-            forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+            forms = candidatesWithLemma.matching_forms(targetufeats)
         if len(forms) == 0 and token['upos'] in ['ADJ', 'ADV'] and targetufeats.get('Degree')=='Pos':
             targetufeats.pop('Degree', None)
-            forms = [form for form,ufeatdict in candidatesWithLemma if all1in2(targetufeats,ufeatdict)]
+            forms = candidatesWithLemma.matching_forms(targetufeats)
         if len(forms) == 0 and token['upos']=='VERB':
             # if the verb token is reflexive ("-ся" oder "-сь"), only replace with reflexive forms
             # and if not, vice versa
             if token["form"][-2:] in self.refl_suffixes:
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemma if c[0][-2:] in self.refl_suffixes]
+                candidatesWithLemmaFiltered = candidatesWithLemma.select([c[0][-2:] in self.refl_suffixes for c in candidatesWithLemma])
             else: 
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemma if c[0][-2:] not in self.refl_suffixes]
+                candidatesWithLemmaFiltered = candidatesWithLemma.select([c[0][-2:] not in self.refl_suffixes for c in candidatesWithLemma])
             
             if targetufeats.get('VerbForm') in ['Fin', None]:
                 # eventually do the same for Imp Aspect, Act Voice, Ind Mood?
                 targetufeats.pop('VerbForm', None)
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemma if c[1].get('VerbForm') in ['Fin', None]]
-                forms = [form for form,ufeatdict in candidatesWithLemmaFiltered if all1in2(targetufeats,ufeatdict)]
+                candidatesWithLemmaFiltered = candidatesWithLemma.select([c[1].get('VerbForm') in ['Fin', None] for c in candidatesWithLemma])
+                forms = candidatesWithLemmaFiltered.matching_forms(targetufeats)
             if len(forms) == 0 and targetufeats.get("Aspect") == "Imp":
                 targetufeats.pop("Aspect", None)
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemmaFiltered if c[1].get("Aspect") in ["Imp", None]]
-                forms = [form for form,ufeatdict in candidatesWithLemmaFiltered if all1in2(targetufeats,ufeatdict)]
+                candidatesWithLemmaFiltered = candidatesWithLemmaFiltered.select([c[1].get("Aspect") in ["Imp", None] for c in candidatesWithLemmaFiltered])
+                forms = candidatesWithLemmaFiltered.matching_forms(targetufeats)
             if len(forms) == 0 and targetufeats.get("Mood") in ["Ind", None]:
                 targetufeats.pop("Mood", None)
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemmaFiltered if c[1].get("Mood") in ["Ind", None]]
-                forms = [form for form,ufeatdict in candidatesWithLemmaFiltered if all1in2(targetufeats,ufeatdict)]
+                candidatesWithLemmaFiltered = candidatesWithLemmaFiltered.select([c[1].get("Mood") in ["Ind", None] for c in candidatesWithLemmaFiltered])
+                forms = candidatesWithLemmaFiltered.matching_forms(targetufeats)
             if len(forms) == 0 and targetufeats.get("Voice") in ["Act", None]:
                 targetufeats.pop("Voice", None)
-                candidatesWithLemmaFiltered = [c for c in candidatesWithLemmaFiltered if c[1].get("Voice") in ["Act", None]]
-                forms = [form for form,ufeatdict in candidatesWithLemmaFiltered if all1in2(targetufeats,ufeatdict)]
+                candidatesWithLemmaFiltered = candidatesWithLemmaFiltered.select([c[1].get("Voice") in ["Act", None] for c in candidatesWithLemmaFiltered])
+                forms = candidatesWithLemmaFiltered.matching_forms(targetufeats)
         return forms
 
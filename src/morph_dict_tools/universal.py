@@ -1,4 +1,10 @@
+import hashlib
 import pickle
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+word_mask = 2**64 - 1
 
 
 
@@ -7,6 +13,163 @@ def all1in2(dict1,dict2):
     """true if all k,v pairs in dict1 are in dict2"""
     return all([dict2.get(k)==v for k,v in dict1.items()])
 
+def stable_hash(string):
+    """returns a 63-bit hash of a string, which is the same in every process 
+    (unlike hash, which is salted per interpreter)"""
+    return int.from_bytes(hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+def pack_strings(strings):
+    """utf-8 encodes a list of strings into one uint8 array. String i is 
+    bytes(data[offsets[i]:offsets[i+1]]).
+
+    :param strings: a list of strings
+    :return: a tuple (data, offsets) of a uint8 array and an int64 array of length len(strings)+1
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8).copy(), offsets
+
+class CompiledLexicon():
+    """The lexicon entries (form, ufeatdict) of one upos as flat numpy arrays.
+
+    The lemmas and forms are utf-8 encoded into one array each (see pack_strings), and 
+    the ufeats of every entry are a row of 64-bit words with one bit per feature value 
+    (see MorphDict.compile_feature_masks). The lemmas are sorted by stable_hash, so a 
+    lemma is found with a binary search over lemma_hashes. The entries of lemma i are 
+    entry_offsets[i]:entry_offsets[i+1], in the order of the lexicon.
+
+    Unlike the nested dicts and lists of upos2lemma2ufeatdictandform, the arrays have 
+    no reference counts, so processes forked after compiling (see parallel_replacement) 
+    read them without copying their pages.
+    """
+    def __init__(self, morphdict, lemma2ufeatdictandform):
+        """
+        :param morphdict: the MorphDict whose feature_value_ids the masks use
+        :param lemma2ufeatdictandform: a dict lemma -> list of (form, ufeatdict), i.e. 
+            upos2lemma2ufeatdictandform[upos]
+        """
+        lemmas = list(lemma2ufeatdictandform)
+        hashes = np.array([stable_hash(lemma) for lemma in lemmas], dtype=np.int64)
+        order = np.argsort(hashes, kind='stable')
+        lemmas = [lemmas[i] for i in order.tolist()]
+        self.lemma_hashes = hashes[order]
+        self.lemma_data, self.lemma_offsets = pack_strings(lemmas)
+        entries = [entry for lemma in lemmas for entry in lemma2ufeatdictandform[lemma]]
+        self.entry_offsets = np.zeros(len(lemmas) + 1, dtype=np.int64)
+        self.entry_offsets[1:] = np.cumsum([len(lemma2ufeatdictandform[lemma]) for lemma in lemmas])
+        self.form_data, self.form_offsets = pack_strings([form for form, _ in entries])
+        self.ends_with_hyphen = np.array([form.endswith('-') for form, _ in entries], dtype=bool)
+        self.masks = morphdict.compile_feature_masks([ufeatdict for _, ufeatdict in entries])
+        # the feature value of every bit, and the bits of all values of every feature
+        self.feature_values = list(morphdict.feature_value_ids)
+        self.feature_name_masks = dict()
+        for bit, (feat, _) in enumerate(self.feature_values):
+            if bit < 64 * self.masks.shape[1]:
+                mask = self.feature_name_masks.setdefault(feat, np.zeros(self.masks.shape[1], dtype=np.uint64))
+                mask[bit // 64] |= np.uint64(1 << (bit % 64))
+
+    @property
+    def num_lemmas(self):
+        return len(self.lemma_hashes)
+
+    def lemma(self, lemma_id):
+        """returns the lemma with an id"""
+        return bytes(self.lemma_data[self.lemma_offsets[lemma_id]:self.lemma_offsets[lemma_id+1]]).decode('utf-8')
+
+    def lemma_id(self, lemma):
+        """returns the id of a lemma, or None if the lemma is not in the lexicon"""
+        if not isinstance(lemma, str):
+            return None
+        key = stable_hash(lemma)
+        i = int(np.searchsorted(self.lemma_hashes, key))
+        while i < len(self.lemma_hashes) and self.lemma_hashes[i] == key:
+            if self.lemma(i) == lemma:
+                return i
+            i += 1
+        return None
+
+    def form(self, entry_id):
+        """returns the form of an entry"""
+        return bytes(self.form_data[self.form_offsets[entry_id]:self.form_offsets[entry_id+1]]).decode('utf-8')
+
+    def ufeatdict(self, mask):
+        """returns the ufeat dict of a bitmask row, e.g. a row of masks"""
+        ufeatdict = dict()
+        for w, word in enumerate(mask.tolist()):
+            while word:
+                bit = (word & -word).bit_length() - 1
+                feat, value = self.feature_values[64 * w + bit]
+                ufeatdict[feat] = value
+                word &= word - 1
+        return ufeatdict
+
+class FeatureCandidates():
+    """Lexicon entries (form, ufeatdict) of a CompiledLexicon, e.g. those of a lemma, with their ufeats as bitmasks.
+
+    Iterating gives the (form, ufeatdict) tuples, like the lists of upos2lemma2ufeatdictandform. 
+    The bitmasks are a row of 64-bit words per entry, with one bit per feature value 
+    (see MorphDict.compile_feature_masks), so matching_forms tests all entries at once.
+    """
+    def __init__(self, morphdict, lexicon, entry_ids, masks):
+        """
+        :param morphdict: the MorphDict whose feature_value_ids the masks use
+        :param lexicon: the CompiledLexicon of the entries
+        :param entry_ids: an int array of the ids of the entries in the lexicon
+        :param masks: the bitmasks of the entries, a uint64 array of shape (len(entry_ids), number of words)
+        """
+        self.morphdict = morphdict
+        self.lexicon = lexicon
+        self.entry_ids = entry_ids
+        self.masks = masks
+
+    def __len__(self):
+        return len(self.entry_ids)
+
+    def __iter__(self):
+        return ((self.lexicon.form(entry_id), self.lexicon.ufeatdict(mask)) for entry_id, mask in zip(self.entry_ids.tolist(), self.masks))
+
+    def forms(self):
+        """returns the forms of the entries"""
+        return [self.lexicon.form(entry_id) for entry_id in self.entry_ids.tolist()]
+
+    def ends_with_hyphen(self):
+        """returns a boolean array of whether the form of each entry ends with '-'"""
+        return self.lexicon.ends_with_hyphen[self.entry_ids]
+
+    def select(self, keep):
+        """returns the candidates for which keep (a list of booleans, one per entry) is True"""
+        keep = np.array(keep, dtype=bool).reshape(len(self.entry_ids))
+        return FeatureCandidates(self.morphdict, self.lexicon, self.entry_ids[keep], self.masks[keep])
+
+    def matching_forms(self, targetufeats):
+        """returns the forms of the entries that have all targetufeats. The same as 
+        [form for form,ufeatdict in candidates if all1in2(targetufeats,ufeatdict)]"""
+        target = self.morphdict.feature_mask(targetufeats, self.masks.shape[1])
+        if target is None:
+            return []
+        matches = ((self.masks & target) == target).all(axis=1)
+        return [self.lexicon.form(entry_id) for entry_id in self.entry_ids[matches].tolist()]
+
+    def with_default_feature(self, feat, value):
+        """returns the candidates with feat=value added to the entries without feat. 
+        The masks are copied, so the lexicon is not changed. feat=value needs a bit in 
+        the masks, see MorphDict.default_features."""
+        bit = (self.morphdict.feature_value_ids or dict()).get((feat, value))
+        if bit is None or bit >= 64 * self.masks.shape[1]:
+            raise ValueError(f'{feat}={value} has no bit in the feature masks, add it to default_features')
+        feat_mask = self.lexicon.feature_name_masks[feat]
+        masks = self.masks.copy()
+        masks[~(masks & feat_mask).any(axis=1), bit // 64] |= np.uint64(1 << (bit % 64))
+        return FeatureCandidates(self.morphdict, self.lexicon, self.entry_ids, masks)
+
+def most_frequent_form(forms):
+    """returns the most frequent form in a list of forms, or None if the list is empty.
+    Ties go to the form that comes first in the list."""
+    if len(forms) == 0:
+        return None
+    return Counter(forms).most_common(1)[0][0]
+
 def featStringToDict(featString, verbose=False):
     """Turns a UD feature string into a dictionary.
 
@@ -76,12 +239,71 @@ def load_morphdict_from_pickle(lang):
         raise ValueError('lang not supported')
 
 class MorphDict():
+    # the lookup cache, the compiled lexicons and the feature indexes are created on first use, 
+    # so morphdicts pickled without them still work
+    lookup_cache = None
+    lookup_cache_size = 2**18
+    lookup_cache_hits = 0
+    lookup_cache_misses = 0
+    feature_value_ids = None
+    compiled_lexicons = None
+    feature_indexes = None
+    inflectable_lemmas_cache = None
+    # feature values that lang_specific_lookup adds to entries (see FeatureCandidates.with_default_feature), 
+    # so they get a bit when the lexicon is compiled
+    default_features = []
+
     def __init__():
         pass
 
     def lookup(self, lemma, token):
         """returns a list of all forms that match the given lemma and the tokens's upos and 
         have all the token's ufeats.
+
+        The results are cached by (lemma, lookup_key(token)) in an LRU cache with at most 
+        lookup_cache_size entries (see set_lookup_cache_size). The list is a copy, so it 
+        can be changed by the caller.
+
+        :param lemma: the lemma to look up. I.e., the lemma of the forms that are returned
+        :param token: the token at which the replacement happens (the token which gets a new form/lemma)
+        :return: a list of all forms that match the given lemma and the tokens's upos and ufeats
+        """
+        return list(self.cached_lookup(lemma, token)[0])
+
+    def lookup_with_preferred_form(self, lemma, token):
+        """like lookup, but also returns the preferred form, i.e. the most frequent of the 
+        forms (see most_frequent_form). It is computed once per cache entry.
+
+        :param lemma: the lemma to look up
+        :param token: the token at which the replacement happens
+        :return: a tuple of the preferred form (None if there are no forms) and the list of all forms
+        """
+        forms, preferred_form = self.cached_lookup(lemma, token)
+        return preferred_form, list(forms)
+
+    def cached_lookup(self, lemma, token):
+        """returns the cached tuple (forms, preferred form) of a lookup, see lookup. 
+        The forms must not be changed."""
+        if self.lookup_cache_size == 0:
+            forms = self.lookup_uncached(lemma, token)
+            return forms, most_frequent_form(forms)
+        if self.lookup_cache is None:
+            self.lookup_cache = OrderedDict()
+        key = (lemma, self.lookup_key(token))
+        if key in self.lookup_cache:
+            self.lookup_cache_hits += 1
+            self.lookup_cache.move_to_end(key)
+            return self.lookup_cache[key]
+        self.lookup_cache_misses += 1
+        forms = self.lookup_uncached(lemma, token)
+        entry = self.lookup_cache[key] = (forms, most_frequent_form(forms))
+        if len(self.lookup_cache) > self.lookup_cache_size:
+            self.lookup_cache.popitem(last=False)
+        return entry
+
+    def lookup_uncached(self, lemma, token):
+        """returns a list of all forms that match the given lemma and the tokens's upos and 
+        have all the token's ufeats, without the cache.
         
         First, some language-unspecific steps are performed. Then, the lookup is perfoemd in the
         language-specific subclass. 
@@ -95,22 +317,261 @@ class MorphDict():
         upos = token['upos']
         targetufeats = dict() if token['feats'] is None else token['feats'].copy() 
         forms = []
-        if upos not in self.upos2lemma2ufeatdictandform:
-            return forms
-        if lemma not in self.upos2lemma2ufeatdictandform[upos]:
+        candidatesWithLemma = self.feature_candidates(upos, lemma)
+        if candidatesWithLemma is None:
             return forms
-        candidatesWithLemma = self.upos2lemma2ufeatdictandform[upos][lemma]
         if "ArabicMorphDict" in str(type(self)):
             return [lemma]
         # filter based on ending with '-' - occurs in de and en so far
         old_form = token['form']
-        candidatesWithLemma = [c for c in candidatesWithLemma if c[0].endswith('-') == old_form.endswith('-')]
+        candidatesWithLemma = candidatesWithLemma.select(candidatesWithLemma.ends_with_hyphen() == old_form.endswith('-'))
         # determine forms (language specific)
         return self.lang_specific_lookup(token, candidatesWithLemma, targetufeats)
 
     def lang_specific_lookup(self, token, candidatesWithLemma, targetufeats):
-        """only implemented in subclasses"""
+        """only implemented in subclasses. candidatesWithLemma is a FeatureCandidates object"""
         pass
+
+    def feature_candidates(self, upos, lemma):
+        """returns the lexicon entries of a lemma as FeatureCandidates, or None if the 
+        lemma is not in the lexicon for the upos (see compiled_lexicon)"""
+        lexicon = self.compiled_lexicon(upos)
+        lemma_id = None if lexicon is None else lexicon.lemma_id(lemma)
+        if lemma_id is None:
+            return None
+        start, end = int(lexicon.entry_offsets[lemma_id]), int(lexicon.entry_offsets[lemma_id+1])
+        return FeatureCandidates(self, lexicon, np.arange(start, end), lexicon.masks[start:end])
+
+    def compiled_lexicon(self, upos):
+        """returns the entries of a upos as a CompiledLexicon. It is built on first use, 
+        and the default_features get their bits first.
+
+        :param upos: the upos
+        :return: the CompiledLexicon, or None if the upos is not in the lexicon
+        """
+        if self.compiled_lexicons is None:
+            self.compiled_lexicons = dict()
+        if upos not in self.compiled_lexicons:
+            if upos not in self.upos2lemma2ufeatdictandform:
+                return None
+            if self.feature_value_ids is None:
+                self.feature_value_ids = dict()
+            for feat_value in self.default_features:
+                self.feature_value_ids.setdefault(feat_value, len(self.feature_value_ids))
+            self.compiled_lexicons[upos] = CompiledLexicon(self, self.upos2lemma2ufeatdictandform[upos])
+        return self.compiled_lexicons[upos]
+
+    def compile_feature_masks(self, ufeatdicts):
+        """returns the ufeats as bitmasks: a uint64 array with a row of 64-bit words per ufeatdict.
+
+        Every feature value (e.g. ('Case', 'Nom')) gets its own bit, in the order of first 
+        occurrence (see feature_value_ids).
+
+        :param ufeatdicts: a list of ufeat dicts
+        :return: a uint64 array of shape (len(ufeatdicts), number of words)
+        """
+        if self.feature_value_ids is None:
+            self.feature_value_ids = dict()
+        masks = []
+        for ufeatdict in ufeatdicts:
+            mask = 0
+            for feat_value in ufeatdict.items():
+                mask |= 1 << self.feature_value_ids.setdefault(feat_value, len(self.feature_value_ids))
+            masks.append(mask)
+        num_words = len(self.feature_value_ids) // 64 + 1
+        return np.array([[(mask >> (64 * w)) & word_mask for w in range(num_words)] for mask in masks], 
+                        dtype=np.uint64).reshape(len(masks), num_words)
+
+    def feature_mask(self, ufeats, num_words):
+        """returns the bitmask of ufeats as num_words 64-bit words, or None if a feature value 
+        has no bit in num_words words. Then no compiled entry with num_words words has it.
+
+        :param ufeats: a ufeat dict
+        :param num_words: the number of words of the bitmasks to match with
+        :return: a uint64 array of length num_words, or None
+        """
+        feature_value_ids = self.feature_value_ids or dict()
+        mask = 0
+        for feat_value in ufeats.items():
+            bit = feature_value_ids.get(feat_value)
+            if bit is None or bit >= 64 * num_words:
+                return None
+            mask |= 1 << bit
+        return np.array([(mask >> (64 * w)) & word_mask for w in range(num_words)], dtype=np.uint64)
+
+    def lookup_key(self, token):
+        """returns a key of everything of the token that the lookup depends on.
+
+        Two tokens with the same key give the same forms for every lemma, so lookups 
+        can be memoized by (lemma, key): the upos, the ufeats, whether the form ends 
+        with '-', and what the language-specific lookup reads from the token.
+
+        :param token: the token at which the replacement happens
+        :return: a hashable tuple
+        """
+        feats = token['feats']
+        ufeats = () if feats is None else tuple(sorted(feats.items()))
+        return (token['upos'], ufeats, token['form'].endswith('-'), self.lang_specific_lookup_key(token))
+
+    def lang_specific_lookup_key(self, token):
+        """returns what lang_specific_lookup reads from the token besides upos and ufeats.
+        Overwritten in subclasses whose lookup depends on the old form."""
+        return None
+
+    def relaxable_feats(self, token):
+        """returns the names of the token's ufeats that lang_specific_lookup may drop 
+        for the token. Overwritten in subclasses that drop features."""
+        return set()
+
+    def required_ufeats(self, token):
+        """returns the ufeats of the token that every form found by lookup has, 
+        i.e. its ufeats without the relaxable ones (see relaxable_feats)"""
+        feats = token['feats'] or dict()
+        relaxable = self.relaxable_feats(token)
+        return {k: v for k, v in feats.items() if k not in relaxable}
+
+    def feature_index(self, upos):
+        """returns the inverted feature index of the lexicon entries of a upos. 
+        It is built on first use.
+
+        The entries are numbered as in the CompiledLexicon of the upos (see compiled_lexicon). 
+        The index is a dict with the keys 'entry_lemma_ids' (the lemma id of every entry, 
+        an int array) and 'postings' (a dict (feat, value) -> sorted int array of the ids 
+        of the entries with this feature value).
+
+        :param upos: the upos
+        :return: the index, or None if the upos is not in the lexicon
+        """
+        if self.feature_indexes is None:
+            self.feature_indexes = dict()
+        if upos not in self.feature_indexes:
+            lexicon = self.compiled_lexicon(upos)
+            if lexicon is None:
+                return None
+            postings = dict()
+            for bit, feat_value in enumerate(lexicon.feature_values[:64 * lexicon.masks.shape[1]]):
+                entry_ids = np.flatnonzero(lexicon.masks[:, bit // 64] & np.uint64(1 << (bit % 64)))
+                if len(entry_ids) > 0:
+                    postings[feat_value] = entry_ids
+            self.feature_indexes[upos] = {
+                'entry_lemma_ids': np.repeat(np.arange(lexicon.num_lemmas, dtype=np.int64), np.diff(lexicon.entry_offsets)),
+                'postings': postings,
+            }
+        return self.feature_indexes[upos]
+
+    def entries_with_ufeats(self, upos, ufeats):
+        """returns the ids of the lexicon entries of a upos that have all the ufeats, 
+        by intersecting the postings of the feature index (see feature_index)
+
+        :param upos: the upos
+        :param ufeats: a ufeat dict
+        :return: a sorted int array of entry ids
+        """
+        index = self.feature_index(upos)
+        if index is None:
+            return np.zeros(0, dtype=np.int64)
+        postings = []
+        for feat_value in ufeats.items():
+            if feat_value not in index['postings']:
+                return np.zeros(0, dtype=np.int64)
+            postings.append(index['postings'][feat_value])
+        if len(postings) == 0:
+            return np.arange(len(index['entry_lemma_ids']), dtype=np.int64)
+        # start with the shortest list, so every intersection is as small as possible
+        postings.sort(key=len)
+        entry_ids = postings[0]
+        for ids in postings[1:]:
+            entry_ids = np.intersect1d(entry_ids, ids, assume_unique=True)
+        return entry_ids
+
+    def inflectable_lemma_ids(self, upos, ufeats):
+        """returns the ids of the lemmas of a upos that have a form with all the ufeats, 
+        as a sorted int array of lemma ids of the CompiledLexicon of the upos
+
+        :param upos: the upos
+        :param ufeats: a ufeat dict
+        :return: a sorted int array of lemma ids
+        """
+        entry_ids = self.entries_with_ufeats(upos, ufeats)
+        if len(entry_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(self.feature_index(upos)['entry_lemma_ids'][entry_ids])
+
+    def inflectable_lemmas(self, upos, ufeats):
+        """returns the lemmas of a upos that have a form with all the ufeats. 
+        The result is cached per (upos, ufeats).
+
+        :param upos: the upos
+        :param ufeats: a ufeat dict
+        :return: a frozenset of lemmas
+        """
+        if self.inflectable_lemmas_cache is None:
+            self.inflectable_lemmas_cache = dict()
+        key = (upos, tuple(sorted(ufeats.items())))
+        if key not in self.inflectable_lemmas_cache:
+            lexicon = self.compiled_lexicon(upos)
+            self.inflectable_lemmas_cache[key] = frozenset(
+                lexicon.lemma(i) for i in self.inflectable_lemma_ids(upos, ufeats).tolist())
+        return self.inflectable_lemmas_cache[key]
+
+    def inflectable_lemmas_for_token(self, token):
+        """returns the lemmas that lookup can find forms of for the token, and maybe some more: 
+        the lemmas with a form that has the required ufeats of the token (see required_ufeats). 
+        A lemma that is not in the set gives no forms."""
+        return self.inflectable_lemmas(token['upos'], self.required_ufeats(token))
+
+    def compile_lookup_structures(self, upos_filter=None, verbose=False):
+        """builds the compiled lexicon (see CompiledLexicon) and the feature index of every upos, 
+        and creates the caches, instead of on first use.
+
+        Call it before forking processes (see parallel_replacement), so the processes 
+        share these structures copy-on-write instead of each building its own copy. 
+        Lookups then only read the numpy arrays of the compiled lexicons, not the 
+        Python objects of upos2lemma2ufeatdictandform.
+
+        :param upos_filter: the upos to build the structures for. If None, all upos of the lexicon
+        :param verbose: if True, print progress
+        """
+        upos_list = [upos for upos in (upos_filter or self.upos2lemma2ufeatdictandform) if upos in self.upos2lemma2ufeatdictandform]
+        for upos in upos_list:
+            print('compile lexicon and feature index for', upos) if verbose else None
+            self.compiled_lexicon(upos)
+            self.feature_index(upos)
+        if self.lookup_cache is None:
+            self.lookup_cache = OrderedDict()
+        if self.inflectable_lemmas_cache is None:
+            self.inflectable_lemmas_cache = dict()
+
+    def set_lookup_cache_size(self, size):
+        """sets the maximum number of entries of the lookup cache. 0 turns the cache off.
+        Least recently used entries are dropped if the cache is too large."""
+        self.lookup_cache_size = size
+        if self.lookup_cache is not None:
+            while len(self.lookup_cache) > size:
+                self.lookup_cache.popitem(last=False)
+
+    def clear_lookup_cache(self):
+        """empties the lookup cache and resets its counters"""
+        self.lookup_cache = None
+        self.lookup_cache_hits = 0
+        self.lookup_cache_misses = 0
+
+    def lookup_cache_info(self):
+        """returns a dict of the hits, misses, current size and maximum size of the lookup cache"""
+        return {
+            'hits': self.lookup_cache_hits,
+            'misses': self.lookup_cache_misses,
+            'size': 0 if self.lookup_cache is None else len(self.lookup_cache),
+            'max_size': self.lookup_cache_size,
+        }
+
+    def __getstate__(self):
+        """the lookup cache, the compiled lexicons and the feature indexes are not pickled"""
+        state = self.__dict__.copy()
+        for name in ['lookup_cache', 'lookup_cache_hits', 'lookup_cache_misses', 'feature_value_ids', 'compiled_lexicons', 
+                     'feature_indexes', 'inflectable_lemmas_cache']:
+            state.pop(name, None)
+        return state
     
     def __len__(self):
         return self.num_entries
@@ -1,5 +1,8 @@
+import itertools
 import random
-import copy
+
+from conllu import Metadata, Token, TokenList
+from conllu.parser import DEFAULT_FIELDS
 
 from src.ud_tools import get_token_with_id
 
@@ -34,74 +37,234 @@ def create_replacement_masks(dep_sents, upos_filter=None):
         masks.append(create_replacement_mask(dep_sent, upos_filter=upos_filter))
     return masks
 
-def make_replacer(lang, syntactic_patterns, morphlex, upos_filter=None):
+def make_replacer(lang, syntactic_patterns, morphlex, upos_filter=None, weighted=False, seed=None):
 
     if lang=='fr':
-        return FrenchReplacer(syntactic_patterns, morphlex, upos_filter=upos_filter)
+        return FrenchReplacer(syntactic_patterns, morphlex, upos_filter=upos_filter, weighted=weighted, seed=seed)
     elif lang=='en':
-        return EnglishReplacer(syntactic_patterns, morphlex, upos_filter=upos_filter)
+        return EnglishReplacer(syntactic_patterns, morphlex, upos_filter=upos_filter, weighted=weighted, seed=seed)
     else:
-        return Replacer(syntactic_patterns, morphlex, upos_filter=upos_filter)
+        return Replacer(syntactic_patterns, morphlex, upos_filter=upos_filter, weighted=weighted, seed=seed)
+
+
+
+
+class TokenOverlay:
+    """A token whose changed fields are stored on top of an unchanged source token.
+
+    Reading a field gives the changed value if there is one, and the source value 
+    otherwise. Dict fields (feats, misc, deps) are copied into the changes when 
+    they are read, so changing them in place never changes the source token.
+    """
+    mutable_fields = ['feats', 'misc', 'deps']
+
+    def __init__(self, token):
+        self.source = token
+        self.changes = dict()
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        value = self.source[key]
+        if key in self.mutable_fields and value is not None:
+            value = self.changes[key] = value.copy()
+        return value
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __contains__(self, key):
+        return key in self.changes or key in self.source
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def peek(self, key):
+        """Reads a field without copying it. The value must not be changed."""
+        return self.changes[key] if key in self.changes else self.source[key]
+
+    def to_token(self):
+        """Returns the token with the changes applied, as a new Token."""
+        token = Token(self.source)
+        token.update(self.changes)
+        return token
+
+
+class SentenceOverlay:
+    """A copy-on-write view of a sentence for the replacement.
+
+    Holds a TokenOverlay per token and its own copy of the metadata, and leaves 
+    the source tokenlist (and thus its tree) unchanged. The sentence is only 
+    materialized as a TokenList by to_tokenlist or serialize.
+    """
+    def __init__(self, dep_sent):
+        self.source = dep_sent
+        self.tokens = [TokenOverlay(token) for token in dep_sent]
+        self.metadata = Metadata(dep_sent.metadata)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __getitem__(self, i):
+        return self.tokens[i]
+
+    def to_tokenlist(self):
+        """Returns the sentence with all changes as a new TokenList."""
+        return TokenList([token.to_token() for token in self.tokens], Metadata(self.metadata), default_fields=DEFAULT_FIELDS)
+
+    def serialize(self):
+        """Serializes the sentence with all changes to a CoNLL-U string."""
+        return self.to_tokenlist().serialize()
 
+    def to_tree(self):
+        """Returns the tokentree of the sentence with all changes."""
+        return self.to_tokenlist().to_tree()
 
 
+class LazyTrees:
+    """A list of the tokentrees of replaced sentences, each built on first access.
+
+    Supports len, indexing (also with slices) and repeated iteration like a list, 
+    but only the trees that are used are built.
+    """
+    def __init__(self, new_dep_sents):
+        self.new_dep_sents = new_dep_sents
+        self.trees = [None] * len(new_dep_sents)
+
+    def __len__(self):
+        return len(self.new_dep_sents)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self.trees[i] is None:
+            self.trees[i] = self.new_dep_sents[i].to_tree()
+        return self.trees[i]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
 
 class Replacer:
-    def __init__(self, syntactic_patterns, morphlex, upos_filter=None):
+    def __init__(self, syntactic_patterns, morphlex, upos_filter=None, weighted=False, seed=None):
         """Create a replacement object.
         
         :param syntactic_patterns: a SyntacticPatterns object
         :param morphlex: a MorphDict object
         :param upos_filter: a list of upos to filter for. If None, no filtering is done
+        :param weighted: if True, replacements are drawn proportional to their frequency 
+            in the treebank of the patterns. Otherwise, every distinct (form, lemma) is equally likely
+        :param seed: if not None, every sentence gets its own random number generator, seeded 
+            with (seed, run id, index of the sentence) (see sentence_rng). The output then does not 
+            depend on how the sentences are split into slices or chunks. Otherwise, the random module is used
         """
         self.syntactic_patterns = syntactic_patterns
         self.morphlex = morphlex
         self.upos_filter = upos_filter
+        self.weighted = weighted
+        self.seed = seed
 
-    def replace_tokens_in_sentences(self, dep_sents, dep_trees, fraction=1., cutoff=10000000, verbose=True):
+    def sentence_rng(self, run_id, sentence_index):
+        """Returns the random number generator of a sentence.
+
+        :param run_id: the id of the run (or variant)
+        :param sentence_index: the index of the sentence in the whole treebank
+        :return: a random.Random seeded with (seed, run_id, sentence_index), or the 
+            random module if the replacer has no seed
+        """
+        if self.seed is None:
+            return random
+        return random.Random(f"{self.seed}-{run_id}-{sentence_index}")
+
+    def replace_tokens_in_sentences(self, dep_sents, dep_trees=None, fraction=1., cutoff=10000000, verbose=True, batch_size=1000, num_variants=None, 
+                                    run_id=0, sentence_offset=0):
         """
         Replace tokens in a list of sentences.
 
-        :param dep_sents: a list of tokenlists
-        :param dep_trees: a list of tokentrees
+        With a batch_size, the sentences are processed in chunks: the signatures and 
+        match counts of all replaceable tokens of a chunk are found at once (see 
+        find_token_signatures). The random draws are the same as without batches, 
+        so the output is the same for the same random seed.
+
+        With num_variants, the signatures and match counts of each sentence are found 
+        once, and num_variants independent replacements are drawn from them.
+
+        With a seed (see Replacer), variant v of sentence k is drawn with the random number 
+        generator of run run_id + v and sentence sentence_offset + k. So one call with 
+        num_variants=3 gives the same variants as three calls with run_id 0, 1 and 2.
+
+        :param dep_sents: a list of tokenlists, or a CompactTreebank (decoded one sentence at a time)
+        :param dep_trees: a list of tokentrees. If None, the trees are built from dep_sents when needed
         :param fraction: a float between 0 and 1. The fraction of tokens to replace.
         :param cutoff: the number of sentences after which to stop
         :param verbose: a boolean. If True, print progress
-        :return: a list of tokenlists and a list of tokentrees with replaced tokens
+        :param batch_size: the number of sentences per chunk. If None, every sentence and 
+            token is handled on its own
+        :param num_variants: the number of variants to draw per sentence. If None, one variant is 
+            drawn and the results are not nested
+        :param run_id: the run id of the (first) variant, used with a seed
+        :param sentence_offset: the index of the first sentence in the whole treebank, used with a seed
+        :return: a list of SentenceOverlays (which serialize like tokenlists) and a list of the 
+            tokentrees of the replaced sentences, which builds each tree on first access (see LazyTrees). 
+            With num_variants, a list of these per variant. The stats are summed over all variants
         """
         # initial steps
-        new_dep_sents = []
-        new_dep_trees = []
-        masks = create_replacement_masks(dep_sents, upos_filter=self.upos_filter)
+        new_dep_sents = [[] for _ in range(num_variants or 1)]
         all_matches_per_upos = dict()
         all_no_forms_for_matches = dict()
-
-        # loop over sentences
-        for k,(dep_sent, dep_tree, mask) in enumerate(zip(dep_sents, dep_trees, masks)):
-            if verbose and k % 100 == 0:
-                print(k,end=", ", flush=True)
-            if k > cutoff:
-                break
-
-            # replace tokens
-            new_dep_sent, new_dep_tree, matches_per_upos, no_forms_for_matches = self.replace_tokens_in_sentence(
-                dep_sent, 
-                dep_tree, 
-                mask,
-                fraction=fraction, 
-                verbose=True)
-
-            # save results
-            for upos, matches in matches_per_upos.items():
-                if upos not in all_matches_per_upos:
-                    all_matches_per_upos[upos] = []
-                all_matches_per_upos[upos] += matches
-            for upos, matches in no_forms_for_matches.items():
-                if upos not in all_no_forms_for_matches:
-                    all_no_forms_for_matches[upos] = []
-                all_no_forms_for_matches[upos] += matches
-            new_dep_sents.append(new_dep_sent)
-            new_dep_trees.append(new_dep_tree)
+        if dep_trees is None:
+            sents_and_trees = ((dep_sent, dep_sent.to_tree()) for dep_sent in dep_sents)
+        else:
+            sents_and_trees = zip(dep_sents, dep_trees)
+
+        # chunks of sentences and trees
+        sents_and_trees = itertools.islice(sents_and_trees, cutoff + 1)
+        chunks = iter(lambda: list(itertools.islice(sents_and_trees, batch_size or 1)), [])
+
+        # loop over chunks and sentences
+        k = 0
+        for chunk in chunks:
+            masks = [create_replacement_mask(dep_sent, upos_filter=self.upos_filter) for dep_sent, _ in chunk]
+            if batch_size is None and num_variants is None:
+                chunk_signatures = [None] * len(chunk)
+            else:
+                chunk_signatures = self.find_token_signatures(chunk, masks)
+            for (dep_sent, dep_tree), mask, token_signatures in zip(chunk, masks, chunk_signatures):
+                if verbose and k % 100 == 0:
+                    print(k,end=", ", flush=True)
+
+                for variant in range(num_variants or 1):
+                    # replace tokens (every variant gets its own copy of the mask)
+                    # the trees are built later, and only when needed
+                    new_dep_sent, _, matches_per_upos, no_forms_for_matches = self.replace_tokens_in_sentence(
+                        dep_sent, 
+                        dep_tree, 
+                        list(mask),
+                        fraction=fraction, 
+                        verbose=True,
+                        token_signatures=token_signatures,
+                        rng=self.sentence_rng(run_id + variant, sentence_offset + k),
+                        build_tree=False)
+
+                    # save results
+                    for upos, matches in matches_per_upos.items():
+                        if upos not in all_matches_per_upos:
+                            all_matches_per_upos[upos] = []
+                        all_matches_per_upos[upos] += matches
+                    for upos, matches in no_forms_for_matches.items():
+                        if upos not in all_no_forms_for_matches:
+                            all_no_forms_for_matches[upos] = []
+                        all_no_forms_for_matches[upos] += matches
+                    new_dep_sents[variant].append(new_dep_sent)
+                k += 1
+
+        # the trees of the new sentences are only built when needed
+        new_dep_trees = [LazyTrees(variant_sents) for variant_sents in new_dep_sents]
+        if num_variants is None:
+            new_dep_sents, new_dep_trees = new_dep_sents[0], new_dep_trees[0]
 
         # return results
         if verbose:
@@ -109,18 +272,73 @@ class Replacer:
         else:
             return new_dep_sents, new_dep_trees
 
-    def replace_tokens_in_sentence(self, dep_sent, dep_tree, mask, fraction=1., verbose=True):
+    def find_token_signatures(self, sents_and_trees, masks):
+        """Finds the signature ids and match counts of all replaceable tokens of a chunk of sentences.
+
+        The tokens are grouped by signature (upos, deprel, deprels to children), so each 
+        distinct signature is looked up once, and by signature id and lemma, so the 
+        matches of each group are counted once.
+
+        :param sents_and_trees: a list of tuples (tokenlist, tokentree)
+        :param masks: the replacement masks of the sentences (see create_replacement_mask)
+        :return: a list with a dict per sentence: token position -> (signature id, number of matches). 
+            The signature id is None if the signature never occurred
+        """
+        # group tokens by signature
+        tokens_per_signature = dict()
+        for i, ((dep_sent, dep_tree), mask) in enumerate(zip(sents_and_trees, masks)):
+            for pos, m in enumerate(mask):
+                if m == -1:
+                    token = dep_sent[pos]
+                    signature = self.syntactic_patterns.token_signature(token, dep_tree)
+                    tokens_per_signature.setdefault(signature, []).append((i, pos, token['lemma']))
+
+        # look up each signature, and count the matches per signature id and lemma
+        token_signatures = [dict() for _ in sents_and_trees]
+        for signature, tokens in tokens_per_signature.items():
+            sig_id = self.syntactic_patterns.signature_ids.get(signature)
+            num_matches_per_lemma = dict()
+            for i, pos, lemma in tokens:
+                if sig_id is None:
+                    num_matches = 0
+                elif lemma in num_matches_per_lemma:
+                    num_matches = num_matches_per_lemma[lemma]
+                else:
+                    # matches with the same lemma don't count
+                    num_matches = num_matches_per_lemma[lemma] = self.syntactic_patterns.count_matches(sig_id, exclude_lemma=lemma)
+                token_signatures[i][pos] = (sig_id, num_matches)
+        return token_signatures
+
+    def replace_tokens_in_sentence(self, dep_sent, dep_tree, mask, fraction=1., verbose=True, token_signatures=None, rng=random, 
+                                   build_tree=True):
+        """Replace tokens in a sentence.
+
+        The replacements are made in a SentenceOverlay of the sentence, so neither 
+        the sentence nor its tree are copied or changed. The tree structure stays 
+        the same, so dep_tree is used for all signatures.
+
+        :param dep_sent: a tokenlist
+        :param dep_tree: the tokentree of dep_sent
+        :param mask: the replacement mask (see create_replacement_mask). Replaced tokens are set to 1
+        :param fraction: a float between 0 and 1. The fraction of tokens to replace.
+        :param verbose: a boolean. If True, also return the stats
+        :param token_signatures: a dict token position -> (signature id, number of matches), 
+            as found by find_token_signatures. If None, they are found here
+        :param rng: the random number generator, e.g. the random module or a random.Random
+        :param build_tree: if True, the tokentree of the replaced sentence is built and returned. 
+            Otherwise None is returned in its place
+        :return: the SentenceOverlay and its tokentree (and the stats if verbose)
+        """
 
         # initial steps
         mask_with_ix = list(enumerate(mask))
-        dep_tree = copy.deepcopy(dep_tree)
-        dep_sent = copy.deepcopy(dep_sent)
+        dep_sent = SentenceOverlay(dep_sent)
         matches_per_upos = dict()
         no_forms_for_matches = dict()
 
         # list of tokens that can be replaced
         try_tokens = [t[0] for t in mask_with_ix if t[1]==-1] 
-        random.shuffle(try_tokens)
+        rng.shuffle(try_tokens)
 
         # progress indicators
         goal_to_replace = int(len(try_tokens) * fraction)
@@ -132,42 +350,55 @@ class Replacer:
                 break
 
             token = dep_sent[try_token]
-            matches = self.syntactic_patterns.find_matches_for_token(token, dep_tree) # tuples (form, lemma)
-            matches = [m for m in matches if m[1] != token['lemma']] # remove matches with the same lemma
+            if token_signatures is not None:
+                sig_id, num_matches = token_signatures[try_token]
+            else:
+                sig_id = self.syntactic_patterns.find_signature_id_for_token(token, dep_tree)
+                # matches with the same lemma don't count
+                num_matches = 0 if sig_id is None else self.syntactic_patterns.count_matches(sig_id, exclude_lemma=token['lemma'])
             # stats
             if token['upos'] not in matches_per_upos:
                 matches_per_upos[token['upos']] = []
-            matches_per_upos[token['upos']].append(len(matches))
+            matches_per_upos[token['upos']].append(num_matches)
 
             # no matches for this token -> can't replace
-            if len(matches)==0:
+            if num_matches==0:
                 continue
 
-            # find an appropriate form
-            random.shuffle(matches)
+            # find an appropriate form. The matches (tuples (form, lemma)) are drawn 
+            # in random order from the bucket, without copying or shuffling it
+            matches = self.syntactic_patterns.iter_matches(sig_id, weighted=self.weighted, exclude_lemma=token['lemma'], rng=rng)
+            # the POS-only baseline only tries a few random matches (see SyntacticPatternsPOSOnly)
+            if self.syntactic_patterns.max_candidates is not None:
+                matches = itertools.islice(matches, self.syntactic_patterns.max_candidates)
             if self.morphlex is not None:
-                # go through lemmas and find the first form that fits
+                # go through lemmas and find the first form that fits. 
+                # A lemma that was looked up already gives no forms again, 
+                # and neither does a lemma without a form with the required features
+                inflectable_lemmas = self.morphlex.inflectable_lemmas_for_token(token)
+                tried_lemmas = set()
+                forms_for_matches = []
                 for _, new_lemma in matches:
-                    forms_for_matches = self.morphlex.lookup(new_lemma, token)
+                    if new_lemma in tried_lemmas or new_lemma not in inflectable_lemmas:
+                        continue
+                    tried_lemmas.add(new_lemma)
+                    # the morphlex also gives the most frequent of the forms. Works well for German nouns
+                    new_word, forms_for_matches = self.morphlex.lookup_with_preferred_form(new_lemma, token)
                     if len(forms_for_matches)>0:
-                        # TODO is this part language-specific? Can it be part of the morphlex, which could return just 1 form?
-                        # select the most frequent element in the list. Works well for German nouns
-                        new_word = max(set(forms_for_matches), key=forms_for_matches.count)
                         break
                     
                 # if no form was found, log this case and try the next token
                 if len(forms_for_matches) == 0:
                     if token['upos'] not in no_forms_for_matches:
                         no_forms_for_matches[token['upos']] = []
-                    no_forms_for_matches[token['upos']].append((token, len(matches)))
+                    no_forms_for_matches[token['upos']].append((token, num_matches))
                     continue    
             else:
-                new_word, new_lemma = matches[0]
+                new_word, new_lemma = next(matches)
 
-            # change the tree
+            # change the sentence (the tree structure stays the same)
             dep_sent[try_token]['form'] = new_word
             dep_sent[try_token]['lemma'] = new_lemma
-            dep_tree = dep_sent.to_tree()
             replaced_tokens += 1
             mask[try_token] = 1
         
@@ -179,20 +410,21 @@ class Replacer:
 
         # adapt metadata
         dep_sent = self.adapt_text_in_metadata(dep_sent)
-        dep_tree = dep_sent.to_tree()
+        new_dep_tree = dep_sent.to_tree() if build_tree else None
 
         # return
         if verbose:
-            return dep_sent, dep_tree, matches_per_upos, no_forms_for_matches
+            return dep_sent, new_dep_tree, matches_per_upos, no_forms_for_matches
         else:
-            return dep_sent, dep_tree
+            return dep_sent, new_dep_tree
 
     def adapt_text_in_metadata(self, dep_sent):
         tok_list_right_spacing = []
         for tok in dep_sent:
             tok_list_right_spacing.append(tok['form'])
-            misc_none = tok['misc']==None
-            spaceafterNo = not(misc_none) and tok['misc'].get('SpaceAfter')=='No'
+            misc = tok.peek('misc')
+            misc_none = misc==None
+            spaceafterNo = not(misc_none) and misc.get('SpaceAfter')=='No'
             if not(spaceafterNo):
                 tok_list_right_spacing.append(' ')
         dep_sent.metadata['text'] = ''.join(tok_list_right_spacing).strip()
@@ -202,8 +434,8 @@ class Replacer:
         return dep_sent, dep_tree, mask
 
 class FrenchReplacer(Replacer):
-    def __init__(self, syntactic_patterns, morphlex, upos_filter=None):
-        super().__init__(syntactic_patterns, morphlex, upos_filter)
+    def __init__(self, syntactic_patterns, morphlex, upos_filter=None, weighted=False, seed=None):
+        super().__init__(syntactic_patterns, morphlex, upos_filter, weighted, seed)
         self.french_vowels_text = ['a', 'e', 'i', 'o', 'u', 'y']
         self.french_gender_to_sing_article = {'Masc': 'le', 'Fem': 'la'}
 
@@ -279,12 +511,11 @@ class FrenchReplacer(Replacer):
             if word_starts_uppercase:
                 tokform = tokform[0].upper() + tokform[1:]
             tok['form'] = tokform
-        dep_tree = dep_sent.to_tree()
         return dep_sent, dep_tree, mask
 
 class EnglishReplacer(Replacer):
-    def __init__(self, syntactic_patterns, morphlex, upos_filter=None):
-        super().__init__(syntactic_patterns, morphlex, upos_filter)
+    def __init__(self, syntactic_patterns, morphlex, upos_filter=None, weighted=False, seed=None):
+        super().__init__(syntactic_patterns, morphlex, upos_filter, weighted, seed)
 
     def postprocess(self, dep_sent, dep_tree, mask):
         """Postprocess the generated sentence
@@ -309,5 +540,4 @@ class EnglishReplacer(Replacer):
             if word_starts_uppercase:
                 tokform = tokform[0].upper() + tokform[1:]
             tok['form'] = tokform
-        dep_tree = dep_sent.to_tree()
         return dep_sent, dep_tree, mask
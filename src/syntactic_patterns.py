@@ -1,22 +1,29 @@
 
-from ud_tools import tokTree2tokSent
+from ud_tools import get_subtree_index, load_ud_treebank, tokTree2tokSent, tokTrees2tokSents
+from compact_treebank import CompactTreebank
+from treebank_cache import file_key, load_compiled_treebank, save_compiled_treebank
+import ast
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import os
 import random
 
+import numpy as np
+
 
 def find_subtree_with_token_ix(dep_tree, i):
     """given a dep tree and an index, find the subtree with that index. 
+
+    Uses the subtree index of the tree (see ud_tools.get_subtree_index), 
+    so only the first lookup in a tree walks the tree.
     
     :param dep_tree: a TokenTree dependency tree
     :param i: the index of the token (aka token['id']) 
     :return: the subtree where the token at the root has the index i
     """
-    if dep_tree.token['id'] == i:
-        return dep_tree
-    for c in dep_tree.children:
-        in_children = find_subtree_with_token_ix(c,i) 
-        if in_children is not None:
-            return in_children
-    return None
+    return get_subtree_index(dep_tree).get(i)
 
 
 
@@ -78,47 +85,685 @@ pattern_configs = {
 }
 
 
+def normalize_pattern_config(pattern_config):
+    """Fills in the defaults of a pattern config (in place).
+
+    :param pattern_config: a pattern config, see pattern_configs
+    :return: the pattern config
+    """
+    # include_self_in_deprels=False, ignore_deprels_for_dependents=None, ignore_dependent_order=False
+    if 'include_self_in_deprels' not in pattern_config:
+        pattern_config['include_self_in_deprels'] = False
+    if 'ignore_deprels_for_dependents' not in pattern_config:
+        pattern_config['ignore_deprels_for_dependents'] = dict()
+    if 'ignore_dependent_order' not in pattern_config:
+        pattern_config['ignore_dependent_order'] = True
+    return pattern_config
+
+
+def build_csr_buckets(sig_ids, lemma_ids, form_ids, num_signatures, counts=None):
+    """Deduplicates (signature, lemma, form) id triples and groups them by signature.
+
+    :param sig_ids: an int array of signature ids
+    :param lemma_ids: an int array of lemma ids, aligned with sig_ids
+    :param form_ids: an int array of form ids, aligned with sig_ids
+    :param num_signatures: the number of signatures
+    :param counts: an int array of how often each triple occurred. Default: once
+    :return: a tuple (offsets, lemma_ids, form_ids, counts). The entries of signature s are 
+        at offsets[s]:offsets[s+1], sorted by lemma id and then by form id. The counts 
+        of equal triples are summed.
+    """
+    if counts is None:
+        counts = np.ones(len(sig_ids), dtype=np.int64)
+    order = np.lexsort((form_ids, lemma_ids, sig_ids))
+    sig_ids, lemma_ids, form_ids, counts = sig_ids[order], lemma_ids[order], form_ids[order], counts[order]
+    # keep the first of each run of equal triples
+    keep = np.ones(len(sig_ids), dtype=bool)
+    keep[1:] = (sig_ids[1:] != sig_ids[:-1]) | (lemma_ids[1:] != lemma_ids[:-1]) | (form_ids[1:] != form_ids[:-1])
+    run_starts = np.flatnonzero(keep)
+    counts = np.add.reduceat(counts, run_starts) if len(run_starts) > 0 else counts.astype(np.int64)
+    sig_ids, lemma_ids, form_ids = sig_ids[keep], lemma_ids[keep], form_ids[keep]
+    offsets = np.zeros(num_signatures + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(sig_ids, minlength=num_signatures))
+    return offsets, lemma_ids, form_ids, counts.astype(np.int64)
+
+
+# the vocabularies and the bucket arrays of a pattern index
+pattern_vocabs = ['signatures', 'forms', 'lemmas']
+pattern_arrays = ['bucket_offsets', 'bucket_lemma_ids', 'bucket_form_ids', 'bucket_counts']
+
+def pattern_vocab_sort_key(value):
+    """The sort key of a signature, form or lemma in the vocabularies of a pattern index. 
+    Works for strings, None and tuples (of these) alike."""
+    return json.dumps(value, ensure_ascii=False)
+
+
+def canonical_pattern_index(index):
+    """Sorts the vocabularies of a pattern index and renumbers the buckets accordingly.
+
+    The ids of signatures, forms and lemmas then do not depend on the order the 
+    patterns were aggregated in (a compact treebank is swept linearly, trees are 
+    walked in pre-order), so neither do the order of the bucket entries and the 
+    matches drawn with a seeded random number generator.
+
+    :param index: a pattern index (see encode_patterns)
+    :return: the pattern index with sorted vocabularies
+    """
+    vocabs, id_maps = dict(), dict()
+    for name in pattern_vocabs:
+        order = sorted(range(len(index[name])), key=lambda i: pattern_vocab_sort_key(index[name][i]))
+        vocabs[name] = [index[name][i] for i in order]
+        id_maps[name] = np.zeros(len(order), dtype=np.int32)
+        id_maps[name][order] = np.arange(len(order), dtype=np.int32)
+    bucket_offsets, bucket_lemma_ids, bucket_form_ids, bucket_counts = build_csr_buckets(
+        np.repeat(id_maps['signatures'], np.diff(index['bucket_offsets'])),
+        id_maps['lemmas'][index['bucket_lemma_ids']],
+        id_maps['forms'][index['bucket_form_ids']],
+        len(vocabs['signatures']),
+        counts=np.asarray(index['bucket_counts']))
+    return {
+        'signatures': vocabs['signatures'],
+        'forms': vocabs['forms'],
+        'lemmas': vocabs['lemmas'],
+        'bucket_offsets': bucket_offsets,
+        'bucket_lemma_ids': bucket_lemma_ids,
+        'bucket_form_ids': bucket_form_ids,
+        'bucket_counts': bucket_counts,
+    }
+
+
+def encode_patterns(patterns):
+    """Encodes patterns as integer ids and groups them in CSR buckets by signature.
+
+    Signatures (upos, deprel, tuple of deprels to children), forms and lemmas 
+    get ids in sorted order (see canonical_pattern_index), so the index is the 
+    same for any order of the patterns.
+
+    :param patterns: a list of patterns (form, lemma, deprel, upos, deprels_to_children)
+    :return: a pattern index, a dict with the vocabularies 'signatures', 'forms' and 'lemmas', 
+        and the arrays 'bucket_offsets', 'bucket_lemma_ids', 'bucket_form_ids' and 'bucket_counts' 
+        (see build_csr_buckets)
+    """
+    signature_ids, form_ids, lemma_ids = dict(), dict(), dict()
+    sig_col, form_col, lemma_col = [], [], []
+    for (form,lemma,deprel,upos,deprels_to_children) in patterns:
+        sig_col.append(signature_ids.setdefault((upos, deprel, tuple(deprels_to_children)), len(signature_ids)))
+        form_col.append(form_ids.setdefault(form, len(form_ids)))
+        lemma_col.append(lemma_ids.setdefault(lemma, len(lemma_ids)))
+    bucket_offsets, bucket_lemma_ids, bucket_form_ids, bucket_counts = build_csr_buckets(
+        np.array(sig_col, dtype=np.int32),
+        np.array(lemma_col, dtype=np.int32),
+        np.array(form_col, dtype=np.int32),
+        len(signature_ids))
+    return canonical_pattern_index({
+        'signatures': list(signature_ids),
+        'forms': list(form_ids),
+        'lemmas': list(lemma_ids),
+        'bucket_offsets': bucket_offsets,
+        'bucket_lemma_ids': bucket_lemma_ids,
+        'bucket_form_ids': bucket_form_ids,
+        'bucket_counts': bucket_counts,
+    })
+
+
+def merge_pattern_indexes(indexes):
+    """Merges pattern indexes into one.
+
+    The vocabularies of the merged index are sorted (see canonical_pattern_index), 
+    so merging the indexes of the shards of a treebank gives the index of the whole treebank.
+
+    :param indexes: a list of pattern indexes, as returned by encode_patterns
+    :return: the merged pattern index
+    """
+    signature_ids, form_ids, lemma_ids = dict(), dict(), dict()
+    sig_cols, lemma_cols, form_cols, count_cols = [], [], [], []
+    for index in indexes:
+        # map the ids of the index to the merged ids
+        sig_map = np.array([signature_ids.setdefault(s, len(signature_ids)) for s in index['signatures']], dtype=np.int32)
+        form_map = np.array([form_ids.setdefault(f, len(form_ids)) for f in index['forms']], dtype=np.int32)
+        lemma_map = np.array([lemma_ids.setdefault(l, len(lemma_ids)) for l in index['lemmas']], dtype=np.int32)
+        bucket_sizes = np.diff(index['bucket_offsets'])
+        sig_cols.append(np.repeat(sig_map, bucket_sizes))
+        lemma_cols.append(lemma_map[index['bucket_lemma_ids']])
+        form_cols.append(form_map[index['bucket_form_ids']])
+        count_cols.append(index['bucket_counts'])
+    bucket_offsets, bucket_lemma_ids, bucket_form_ids, bucket_counts = build_csr_buckets(
+        np.concatenate(sig_cols or [np.zeros(0, dtype=np.int32)]),
+        np.concatenate(lemma_cols or [np.zeros(0, dtype=np.int32)]),
+        np.concatenate(form_cols or [np.zeros(0, dtype=np.int32)]),
+        len(signature_ids),
+        counts=np.concatenate(count_cols or [np.zeros(0, dtype=np.int64)]))
+    return canonical_pattern_index({
+        'signatures': list(signature_ids),
+        'forms': list(form_ids),
+        'lemmas': list(lemma_ids),
+        'bucket_offsets': bucket_offsets,
+        'bucket_lemma_ids': bucket_lemma_ids,
+        'bucket_form_ids': bucket_form_ids,
+        'bucket_counts': bucket_counts,
+    })
+
+
+# (synt_patterns, treebank, upos_filter) of a parallel build, set before the workers are forked
+shard_source = None
+
+def build_shard_index(bounds):
+    """Builds the pattern index of the trees start:end of the treebank in shard_source.
+
+    :param bounds: a tuple (start, end)
+    :return: a pattern index, as returned by encode_patterns
+    """
+    synt_patterns, treebank, upos_filter = shard_source
+    start, end = bounds
+    patterns = synt_patterns.aggregate_patterns_from_treebank(treebank[start:end], upos_filter=upos_filter)
+    return encode_patterns(patterns)
+
+
+def add_to_vocab(ids, vocab, value):
+    """Returns the id of value in a vocabulary (a dict value -> id and a list id -> value), 
+    and appends it first if it is new."""
+    if value not in ids:
+        ids[value] = len(vocab)
+        vocab.append(value)
+    return ids[value]
+
+
+def search_buckets(offsets, keys, sig_ids, new_keys):
+    """Finds the insert positions of keys in their buckets, with a binary search for all keys at once.
+
+    :param offsets: the bucket offsets (see build_csr_buckets)
+    :param keys: an int64 array of the keys of the entries, sorted within each bucket
+    :param sig_ids: the bucket of each new key
+    :param new_keys: the new keys
+    :return: for each new key, the first position in its bucket whose key is not smaller
+    """
+    lo, hi = offsets[sig_ids], offsets[sig_ids + 1]
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        smaller = np.zeros(len(mid), dtype=bool)
+        smaller[active] = keys[mid[active]] < new_keys[active]
+        lo = np.where(active & smaller, mid + 1, lo)
+        hi = np.where(active & ~smaller, mid, hi)
+
+
+def lazy_permutation(n, rng=random):
+    """Yields 0..n-1 in random order, with a Fisher-Yates shuffle that only 
+    stores the swapped positions. Each draw is O(1), and stopping early costs nothing.
+
+    :param n: the number of positions
+    :param rng: the random number generator, e.g. the random module or a random.Random
+    """
+    swapped = dict()
+    for i in range(n):
+        j = rng.randrange(i, n)
+        yield swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+
+
+def weighted_lazy_permutation(counts, cum_counts, start, end, gap_start=None, gap_end=None, rng=random):
+    """Yields the positions start..end-1 except gap_start..gap_end-1 in random order 
+    without replacement, where each next position is drawn with a probability 
+    proportional to its count.
+
+    While at least half of the weight is left, positions are drawn from the 
+    cumulative counts (O(log n), the gap is skipped by shifting the drawn value) 
+    and positions that were drawn already are drawn again. The rest is ordered 
+    with exponential keys (Efraimidis-Spirakis).
+
+    :param counts: the counts of the entries
+    :param cum_counts: the cumulative sum of counts
+    :param start: the first position
+    :param end: the end position (exclusive)
+    :param gap_start: the first position to leave out. Default: no gap
+    :param gap_end: the end of the positions to leave out (exclusive)
+    :param rng: the random number generator, e.g. the random module or a random.Random
+    """
+    if gap_start is None:
+        gap_start = gap_end = start
+    cum_before = lambda position: int(cum_counts[position-1]) if position > 0 else 0
+    base = cum_before(start)
+    weight_before_gap = cum_before(gap_start) - base
+    gap_weight = cum_before(gap_end) - cum_before(gap_start)
+    total = cum_before(end) - base - gap_weight
+    drawn = set()
+    drawn_weight = 0
+    while 2 * drawn_weight < total:
+        r = rng.randrange(total)
+        if r >= weight_before_gap:
+            r += gap_weight
+        position = start + int(np.searchsorted(cum_counts[start:end], base + r, side='right'))
+        if position in drawn:
+            continue
+        drawn.add(position)
+        drawn_weight += int(counts[position])
+        yield position
+    remaining = [position for position in itertools.chain(range(start, gap_start), range(gap_end, end)) 
+                 if position not in drawn]
+    keys = {position: rng.random() ** (1. / int(counts[position])) for position in remaining}
+    yield from sorted(remaining, key=keys.get, reverse=True)
+
+
+# the version of the pattern index files, part of their key
+pattern_index_version = 3
+
+def pattern_index_to_arrays(index):
+    """Turns a pattern index into a dict of numpy arrays, e.g. for save_compiled_treebank.
+
+    The vocabularies are stored as utf-8 encoded json lists.
+    """
+    arrays = {
+        name + '_json': np.frombuffer(json.dumps(index[name]).encode('utf-8'), dtype=np.uint8) 
+        for name in pattern_vocabs}
+    arrays.update({name: index[name] for name in pattern_arrays})
+    return arrays
+
+
+def pattern_index_from_arrays(arrays):
+    """Inverse of pattern_index_to_arrays. The bucket arrays are used as they are (e.g. memory-mapped)."""
+    index = {name: json.loads(bytes(arrays[name + '_json']).decode('utf-8')) for name in pattern_vocabs}
+    index['signatures'] = [(upos, deprel, tuple(deprels_to_children)) for upos, deprel, deprels_to_children in index['signatures']]
+    index.update({name: arrays[name] for name in pattern_arrays})
+    return index
+
+
+def pattern_index_key(filenames, upos_filter, pattern_config, patterns_class_name='SyntacticPatterns'):
+    """The key of a pattern index: the keys of the treebank files, the upos filter, 
+    the normalized pattern config and the kind of patterns.
+
+    :param filenames: the treebank files the patterns are aggregated from
+    :param upos_filter: a list of upos to filter on, or None
+    :param pattern_config: a pattern config, see pattern_configs
+    :param patterns_class_name: the name of the class of the patterns, e.g. 'SyntacticPatternsPOSOnly'
+    :return: a json-compatible dict
+    """
+    return {
+        'version': pattern_index_version,
+        'patterns_class': patterns_class_name,
+        'treebanks': [file_key(filename) for filename in filenames],
+        'upos_filter': upos_filter,
+        # json round trip, so the key compares equal to the one read from a file
+        'pattern_config': json.loads(json.dumps(normalize_pattern_config(dict(pattern_config)), sort_keys=True)),
+    }
+
+
+def pattern_index_path(filenames, upos_filter, pattern_config, cache_dir, patterns_class_name='SyntacticPatterns'):
+    """The path of the pattern index file for a combination of treebank files, upos filter, 
+    pattern config and kind of patterns."""
+    settings = json.dumps([
+        [os.path.abspath(filename) for filename in filenames], 
+        upos_filter, 
+        normalize_pattern_config(dict(pattern_config)), 
+        patterns_class_name], sort_keys=True)
+    settings_hash = hashlib.sha1(settings.encode('utf-8')).hexdigest()[:16]
+    name = '+'.join(os.path.basename(filename) for filename in filenames)
+    return os.path.join(cache_dir, name + '.' + settings_hash + '.spudpat')
+
+
+def load_syntactic_patterns(filenames, cache_dir, upos_filter=None, pattern_config=dict(), treebank=None, num_processes=None, verbose=True, 
+                            patterns_class=None):
+    """Loads the syntactic patterns of treebank files through an index file.
+
+    If the index file was built from the same files (same path, size and hash) 
+    with the same upos filter and pattern config, it is memory-mapped. Otherwise 
+    the patterns are aggregated again and the index file is (re)written.
+
+    :param filenames: the treebank files, e.g. [dev, test]
+    :param cache_dir: the directory of the index files
+    :param upos_filter: a list of upos to filter on. If None, no filtering is done
+    :param pattern_config: a dict of configs for the pattern matching, see pattern_configs
+    :param treebank: the treebank of the files, used when the index is rebuilt. 
+        If None, the files are loaded as compact treebanks and concatenated
+    :param num_processes: the number of processes to build the index with (see SyntacticPatterns)
+    :param verbose: whether to print progress information
+    :param patterns_class: the class of the patterns, SyntacticPatterns (default) or SyntacticPatternsPOSOnly
+    :return: a patterns_class object
+    """
+    patterns_class = patterns_class or SyntacticPatterns
+    key = pattern_index_key(filenames, upos_filter, pattern_config, patterns_class.__name__)
+    index_file = pattern_index_path(filenames, upos_filter, pattern_config, cache_dir, patterns_class.__name__)
+    if os.path.exists(index_file):
+        cached_key, arrays = load_compiled_treebank(index_file)
+        if cached_key == key:
+            print('load cached pattern index ', index_file) if verbose else None
+            return patterns_class.from_index(pattern_index_from_arrays(arrays), upos_filter=upos_filter, pattern_config=pattern_config)
+        print('cached pattern index is stale, aggregate patterns again') if verbose else None
+    if treebank is None:
+        treebank = CompactTreebank.concatenate([
+            load_ud_treebank(filename, verbose=verbose, compact=True) for filename in filenames])
+    synt_patterns = patterns_class(
+        treebank, 
+        upos_filter=upos_filter, 
+        verbose=verbose, 
+        pattern_config=pattern_config, 
+        num_processes=num_processes)
+    print('write pattern index ', index_file) if verbose else None
+    save_compiled_treebank(pattern_index_to_arrays(synt_patterns.index()), key, index_file)
+    return synt_patterns
+
+
 class SyntacticPatterns():
-    def __init__(self, treebank, upos_filter=None, verbose=False, pattern_config=dict()):
+    # the maximum number of matches the replacer tries for a token, None for all of them
+    max_candidates = None
+
+    def __init__(self, treebank, upos_filter=None, verbose=False, pattern_config=dict(), num_processes=None):
         """Aggregates all patterns from a treebank, and sorts them.
 
-        :param treebank: the treebank
+        :param treebank: the treebank. A list of TokenTrees, or a CompactTreebank
         :param upos_filter: a list of upos to filter on. If None, no filtering is done
         :param verbose: whether to print progress information
         :param pattern_config: a dict of configs for the pattern matching. See pattern_configs for an example. 
                                 If a parameter is not specified, the less restrictive one is used. 
+        :param num_processes: if > 1, the patterns are aggregated in a process pool 
+                                (see build_index_in_parallel). The index is the same as for the serial build.
         """
 
         self.upos_filter = upos_filter
-        # include_self_in_deprels=False, ignore_deprels_for_dependents=None, ignore_dependent_order=False
-        if 'include_self_in_deprels' not in pattern_config:
-            pattern_config['include_self_in_deprels'] = False
-        if 'ignore_deprels_for_dependents' not in pattern_config:
-            pattern_config['ignore_deprels_for_dependents'] = dict()
-        if 'ignore_dependent_order' not in pattern_config:
-            pattern_config['ignore_dependent_order'] = True
-        self.pattern_config=pattern_config
-
-        patterns = self.aggregate_patterns_from_treebank(
-            treebank, 
-            upos_filter=upos_filter, 
-            verbose=verbose)
-        # drop duplicates
-        print('Patterns before dropping duplicates: ', len(patterns)) if verbose else None
-        patterns = list(set(patterns))
-        print('Patterns after dropping duplicates: ', len(patterns)) if verbose else None
-        self.num_patterns = len(patterns)
-        # create dictionary of patterns
-        self.patterns_dict = dict() # upos -> deprel -> deprels_to_children -> list(forms)
-        for (form,lemma,deprel,upos,deprels_to_children) in patterns:
-            if upos not in self.patterns_dict:
-                self.patterns_dict[upos] = dict()
-            if deprel not in self.patterns_dict[upos]:
-                self.patterns_dict[upos][deprel] = dict()
-            if deprels_to_children not in self.patterns_dict[upos][deprel]:
-                self.patterns_dict[upos][deprel][deprels_to_children] = []
-            self.patterns_dict[upos][deprel][deprels_to_children].append((form,lemma))
-    
+        self.pattern_config = normalize_pattern_config(pattern_config)
+
+        if num_processes is not None and num_processes > 1:
+            self.build_index_in_parallel(
+                treebank, 
+                upos_filter=upos_filter, 
+                num_processes=num_processes, 
+                verbose=verbose)
+        else:
+            patterns = self.aggregate_patterns_from_treebank(
+                treebank, 
+                upos_filter=upos_filter, 
+                verbose=verbose)
+            print('Patterns before dropping duplicates: ', len(patterns)) if verbose else None
+            self.build_index(patterns)
+        print('Patterns after dropping duplicates: ', self.num_patterns) if verbose else None
+
+    @classmethod
+    def from_index(cls, index, upos_filter=None, pattern_config=dict()):
+        """Creates syntactic patterns from a pattern index, without a treebank.
+
+        :param index: a pattern index, e.g. as returned by pattern_index_from_arrays
+        :param upos_filter: the upos filter the index was built with
+        :param pattern_config: the pattern config the index was built with
+        :return: a SyntacticPatterns object
+        """
+        synt_patterns = cls.__new__(cls)
+        synt_patterns.upos_filter = upos_filter
+        synt_patterns.pattern_config = normalize_pattern_config(pattern_config)
+        synt_patterns.set_index(index)
+        return synt_patterns
+
+    def index(self):
+        """Returns the pattern index (see encode_patterns)."""
+        return {
+            'signatures': self.signatures,
+            'forms': self.forms,
+            'lemmas': self.lemmas,
+            'bucket_offsets': self.bucket_offsets,
+            'bucket_lemma_ids': self.bucket_lemma_ids,
+            'bucket_form_ids': self.bucket_form_ids,
+            'bucket_counts': self.bucket_counts,
+        }
+
+    def build_index(self, patterns):
+        """Encodes patterns as integer ids and stores them in CSR buckets (see encode_patterns).
+
+        :param patterns: a list of patterns (form, lemma, deprel, upos, deprels_to_children)
+        """
+        self.set_index(encode_patterns(patterns))
+
+    def set_index(self, index):
+        """Sets the pattern index.
+
+        Each signature (upos, deprel, tuple of deprels to children) has an id 
+        (signature_ids / signatures), and forms and lemmas are interned 
+        (form_ids / forms, lemma_ids / lemmas). The deduplicated entries of 
+        signature s are bucket_form_ids[o[s]:o[s+1]] and bucket_lemma_ids[o[s]:o[s+1]] 
+        with o = bucket_offsets, sorted by lemma id. bucket_counts holds how often 
+        each entry occurred, and bucket_cum_counts its cumulative sum for weighted sampling. 
+        The runs of equal lemmas are indexed by build_lemma_groups.
+
+        :param index: a pattern index, as returned by encode_patterns or merge_pattern_indexes
+        """
+        self.signatures = list(index['signatures'])
+        self.forms = list(index['forms'])
+        self.lemmas = list(index['lemmas'])
+        self.signature_ids = {signature: i for i, signature in enumerate(self.signatures)}
+        self.form_ids = {form: i for i, form in enumerate(self.forms)}
+        self.lemma_ids = {lemma: i for i, lemma in enumerate(self.lemmas)}
+        self.bucket_offsets = index['bucket_offsets']
+        self.bucket_lemma_ids = index['bucket_lemma_ids']
+        self.bucket_form_ids = index['bucket_form_ids']
+        self.bucket_counts = index['bucket_counts']
+        self.bucket_cum_counts = np.cumsum(self.bucket_counts)
+        self.num_patterns = len(self.bucket_form_ids)
+        self.build_lemma_groups()
+
+    def build_index_in_parallel(self, treebank, upos_filter=None, num_processes=None, verbose=False):
+        """Aggregates the patterns of a treebank in a process pool and sets the merged index.
+
+        The treebank is split into consecutive shards, each worker builds the 
+        index of a shard, and the shard indexes are merged in order, so the index 
+        is the same as the one of the serial build.
+
+        :param treebank: the treebank. A list of TokenTrees, or a CompactTreebank
+        :param upos_filter: a list of upos to filter on. If None, no filtering is done
+        :param num_processes: the number of worker processes. Default: all cores
+        :param verbose: whether to print progress information
+        """
+        global shard_source
+        num_processes = num_processes or mp.cpu_count()
+        if not isinstance(treebank, CompactTreebank):
+            treebank = list(treebank)
+        # a few shards per process, so that the processes finish at about the same time
+        num_shards = min(num_processes * 4, max(len(treebank), 1))
+        bounds = [len(treebank) * k // num_shards for k in range(num_shards + 1)]
+        # the workers are forked, so they see the treebank without pickling it
+        shard_source = (self, treebank, upos_filter)
+        try:
+            with mp.get_context('fork').Pool(num_processes) as pool:
+                shard_indexes = pool.map(build_shard_index, zip(bounds[:-1], bounds[1:]))
+        finally:
+            shard_source = None
+        print('merge ', len(shard_indexes), ' shard indexes') if verbose else None
+        self.set_index(merge_pattern_indexes(shard_indexes))
+
+    def add_trees(self, treebank, verbose=False, num_processes=None):
+        """Adds the patterns of more trees to the index.
+
+        Only the new patterns are deduplicated and inserted into the buckets. The 
+        existing entries are only sorted again if the trees add to the vocabularies 
+        (see add_index).
+
+        :param treebank: the trees to add. A list of TokenTrees, or a CompactTreebank
+        :param verbose: whether to print progress information
+        :param num_processes: if > 1, the patterns of the trees are aggregated in a process pool
+        """
+        if num_processes is not None and num_processes > 1:
+            new_patterns = type(self).from_index(
+                encode_patterns([]), 
+                upos_filter=self.upos_filter, 
+                pattern_config=self.pattern_config)
+            new_patterns.build_index_in_parallel(treebank, upos_filter=self.upos_filter, num_processes=num_processes, verbose=verbose)
+            index = new_patterns.index()
+        else:
+            index = encode_patterns(self.aggregate_patterns_from_treebank(treebank, upos_filter=self.upos_filter, verbose=verbose))
+        self.add_index(index)
+        print('Patterns after adding trees: ', self.num_patterns) if verbose else None
+
+    def merge(self, other):
+        """Adds the patterns of other syntactic patterns to this index (in place).
+
+        Merging the patterns of consecutive treebanks gives the same index as 
+        aggregating the patterns of their concatenation.
+
+        :param other: a SyntacticPatterns object with the same upos filter and pattern config
+        """
+        if other.upos_filter != self.upos_filter or other.pattern_config != self.pattern_config:
+            raise ValueError('cannot merge syntactic patterns with different upos filters or pattern configs')
+        self.add_index(other.index())
+
+    def add_index(self, index):
+        """Adds the entries of a pattern index to the index.
+
+        If the index has new signatures, forms or lemmas, they are appended to the 
+        vocabularies first, and the index is put into the canonical order at the end 
+        (see canonical_pattern_index).
+
+        :param index: a pattern index (see encode_patterns)
+        """
+        vocab_sizes = (len(self.signatures), len(self.forms), len(self.lemmas))
+        # map the ids of the index to ids of this index, new strings are appended to the vocabularies
+        sig_map = np.array([add_to_vocab(self.signature_ids, self.signatures, s) for s in index['signatures']], dtype=np.int32)
+        form_map = np.array([add_to_vocab(self.form_ids, self.forms, f) for f in index['forms']], dtype=np.int32)
+        lemma_map = np.array([add_to_vocab(self.lemma_ids, self.lemmas, l) for l in index['lemmas']], dtype=np.int32)
+        num_signatures = len(self.signatures)
+        offsets = np.zeros(num_signatures + 1, dtype=np.int64)
+        offsets[:len(self.bucket_offsets)] = self.bucket_offsets
+        offsets[len(self.bucket_offsets):] = self.bucket_offsets[-1]
+
+        # the new entries in the order of the buckets (deduplicated by build_csr_buckets)
+        new_offsets, new_lemma_ids, new_form_ids, new_counts = build_csr_buckets(
+            np.repeat(sig_map, np.diff(index['bucket_offsets'])),
+            lemma_map[index['bucket_lemma_ids']],
+            form_map[index['bucket_form_ids']],
+            num_signatures,
+            counts=index['bucket_counts'])
+        new_sig_ids = np.repeat(np.arange(num_signatures, dtype=np.int32), np.diff(new_offsets))
+
+        # entries are sorted by (lemma id, form id) within a bucket, i.e. by lemma id * len(forms) + form id
+        num_forms = len(self.forms)
+        keys = self.bucket_lemma_ids.astype(np.int64) * num_forms + self.bucket_form_ids
+        new_keys = new_lemma_ids.astype(np.int64) * num_forms + new_form_ids
+        positions = search_buckets(offsets, keys, new_sig_ids, new_keys)
+        is_new = positions == offsets[new_sig_ids + 1]
+        if len(keys) > 0:
+            is_new |= keys[np.minimum(positions, len(keys) - 1)] != new_keys
+        # entries that exist already only add to the counts
+        bucket_counts = np.array(self.bucket_counts, dtype=np.int64)
+        bucket_counts[positions[~is_new]] += new_counts[~is_new]
+        positions, new_sig_ids = positions[is_new], new_sig_ids[is_new]
+
+        self.bucket_lemma_ids = np.insert(self.bucket_lemma_ids, positions, new_lemma_ids[is_new])
+        self.bucket_form_ids = np.insert(self.bucket_form_ids, positions, new_form_ids[is_new])
+        self.bucket_counts = np.insert(bucket_counts, positions, new_counts[is_new])
+        self.bucket_cum_counts = np.cumsum(self.bucket_counts)
+        offsets[1:] += np.cumsum(np.bincount(new_sig_ids, minlength=num_signatures))
+        self.bucket_offsets = offsets
+        self.num_patterns = len(self.bucket_form_ids)
+        if vocab_sizes != (len(self.signatures), len(self.forms), len(self.lemmas)):
+            self.set_index(canonical_pattern_index(self.index()))
+        else:
+            self.build_lemma_groups()
+
+    @property
+    def patterns_dict(self):
+        """The patterns as nested dicts upos -> deprel -> str(deprels_to_children) -> list of (form, lemma).
+
+        Built from the buckets on every access, for inspection only.
+        """
+        patterns_dict = dict()
+        for sig_id, (upos, deprel, deprels_to_children) in enumerate(self.signatures):
+            patterns_dict.setdefault(upos, dict()).setdefault(deprel, dict())[str(list(deprels_to_children))] = self.matches_for_signature(sig_id)
+        return patterns_dict
+
+    def find_signature_id(self, upos, deprel, deprels_to_children):
+        """Finds the id of a signature.
+
+        :param upos: the upos of the pattern
+        :param deprel: the deprel of the pattern
+        :param deprels_to_children: the deprels to the children of the pattern, as a list
+            (or as its string representation)
+        :return: the signature id, or None if the signature never occurred
+        """
+        if isinstance(deprels_to_children, str):
+            deprels_to_children = ast.literal_eval(deprels_to_children)
+        return self.signature_ids.get((upos, deprel, tuple(deprels_to_children)))
+
+    def matches_for_signature(self, sig_id):
+        """Returns the list of (form, lemma) tuples in the bucket of a signature id."""
+        start, end = self.bucket_offsets[sig_id], self.bucket_offsets[sig_id+1]
+        return [(self.forms[f], self.lemmas[l]) for f, l in zip(
+            self.bucket_form_ids[start:end].tolist(), 
+            self.bucket_lemma_ids[start:end].tolist())]
+
+    def build_lemma_groups(self):
+        """Indexes the runs of equal lemmas in the buckets (the entries of a bucket are sorted by lemma).
+
+        Group g spans the entries group_starts[g]:group_starts[g+1] and has the lemma 
+        group_lemma_ids[g]. The groups of signature s are bucket_group_offsets[s]:bucket_group_offsets[s+1].
+        """
+        is_start = np.ones(len(self.bucket_lemma_ids), dtype=bool)
+        is_start[1:] = self.bucket_lemma_ids[1:] != self.bucket_lemma_ids[:-1]
+        # a bucket always starts a new group
+        is_start[self.bucket_offsets[:-1][self.bucket_offsets[:-1] < len(is_start)]] = True
+        group_starts = np.flatnonzero(is_start)
+        self.group_lemma_ids = self.bucket_lemma_ids[group_starts]
+        self.group_starts = np.append(group_starts, len(is_start))
+        self.bucket_group_offsets = np.searchsorted(group_starts, self.bucket_offsets)
+
+    def lemma_group_range(self, sig_id, lemma):
+        """Finds the entries with a lemma in the bucket of a signature id, with a binary search over its lemma groups.
+
+        :param sig_id: the signature id
+        :param lemma: the lemma
+        :return: a tuple (start, end) of the positions of the entries. Empty (start == end) if there are none
+        """
+        start = int(self.bucket_offsets[sig_id])
+        lemma_id = None if lemma is None else self.lemma_ids.get(lemma)
+        if lemma_id is None:
+            return start, start
+        first_group, end_group = self.bucket_group_offsets[sig_id], self.bucket_group_offsets[sig_id+1]
+        group = first_group + int(np.searchsorted(self.group_lemma_ids[first_group:end_group], lemma_id))
+        if group == end_group or self.group_lemma_ids[group] != lemma_id:
+            return start, start
+        return int(self.group_starts[group]), int(self.group_starts[group+1])
+
+    def count_matches(self, sig_id, exclude_lemma=None):
+        """Returns the number of entries in the bucket of a signature id.
+
+        :param sig_id: the signature id
+        :param exclude_lemma: if not None, entries with this lemma are not counted
+        """
+        gap_start, gap_end = self.lemma_group_range(sig_id, exclude_lemma)
+        return int(self.bucket_offsets[sig_id+1] - self.bucket_offsets[sig_id]) - (gap_end - gap_start)
+
+    def sample_match(self, sig_id, weighted=False, exclude_lemma=None, rng=random):
+        """Draws one (form, lemma) tuple from the bucket of a signature id, without copying the bucket.
+
+        :param sig_id: the signature id
+        :param weighted: if True, entries are drawn proportional to how often they occurred 
+            in the treebank (O(log n)). Otherwise uniformly (O(1))
+        :param exclude_lemma: if not None, entries with this lemma are not drawn
+        :param rng: the random number generator, e.g. the random module or a random.Random
+        :return: a tuple (form, lemma), or None if there is nothing to draw
+        """
+        return next(self.iter_matches(sig_id, weighted=weighted, exclude_lemma=exclude_lemma, rng=rng), None)
+
+    def iter_matches(self, sig_id, weighted=False, exclude_lemma=None, rng=random):
+        """Yields the (form, lemma) tuples of the bucket of a signature id in random order, 
+        without replacement and without copying the bucket.
+
+        The entries with exclude_lemma are one range of the bucket (see lemma_group_range), 
+        which the draws skip by mapping around it.
+
+        :param sig_id: the signature id
+        :param weighted: if True, entries are drawn proportional to how often they occurred 
+            in the treebank (see weighted_lazy_permutation). Otherwise uniformly (see lazy_permutation)
+        :param exclude_lemma: if not None, entries with this lemma are left out
+        :param rng: the random number generator, e.g. the random module or a random.Random
+        """
+        start, end = int(self.bucket_offsets[sig_id]), int(self.bucket_offsets[sig_id+1])
+        gap_start, gap_end = self.lemma_group_range(sig_id, exclude_lemma)
+        if weighted:
+            positions = weighted_lazy_permutation(
+                self.bucket_counts, self.bucket_cum_counts, start, end, gap_start=gap_start, gap_end=gap_end, rng=rng)
+        else:
+            gap_length, before_gap = gap_end - gap_start, gap_start - start
+            positions = (start + i + (gap_length if i >= before_gap else 0) 
+                         for i in lazy_permutation(end - start - gap_length, rng=rng))
+        for position in positions:
+            yield self.forms[self.bucket_form_ids[position]], self.lemmas[self.bucket_lemma_ids[position]]
 
     def find_matches(self, upos, deprel, deprels_to_children):
         """Finds all tuples of form and lemma for a pattern.
@@ -128,14 +773,31 @@ class SyntacticPatterns():
         :param deprels_to_children: the deprels to the children of the pattern
         :return: a list of forms
         """
-        if upos not in self.patterns_dict:
-            return []
-        if deprel not in self.patterns_dict[upos]:
-            return []
-        if deprels_to_children not in self.patterns_dict[upos][deprel]:
+        sig_id = self.find_signature_id(upos, deprel, deprels_to_children)
+        if sig_id is None:
             return []
-        return self.patterns_dict[upos][deprel][deprels_to_children]
+        return self.matches_for_signature(sig_id)
+
+
+    def find_signature_id_for_token(self, token, dep_tree):
+        """Finds the signature id of a token.
 
+        :param token: the token
+        :param dep_tree: the dependency tree of the sentence
+        :return: the signature id, or None if the signature never occurred
+        """
+        return self.signature_ids.get(self.token_signature(token, dep_tree))
+
+    def token_signature(self, token, dep_tree):
+        """Returns the signature (upos, deprel, deprels to children) of a token, 
+        as used as key of signature_ids.
+
+        :param token: the token
+        :param dep_tree: the dependency tree of the sentence
+        :return: a tuple (upos, deprel, tuple of deprels to children)
+        """
+        deprels_to_children = self.find_deprels_to_children(dep_tree, token['id'])
+        return (token['upos'], token['deprel'], tuple(deprels_to_children))
 
     def find_matches_for_token(self, token, dep_tree):
         """Finds all tuples of form and lemma that match the given token.
@@ -147,7 +809,7 @@ class SyntacticPatterns():
         upos = token['upos']
         deprel = token['deprel']
         i = token['id']
-        deprels_to_children = str(self.find_deprels_to_children(dep_tree, i))
+        deprels_to_children = self.find_deprels_to_children(dep_tree, i)
         return self.find_matches(upos, deprel, deprels_to_children)
     
 
@@ -162,39 +824,37 @@ class SyntacticPatterns():
         pd.DataFrame(synt_patterns.stats()) or similar.
         """
         res_dict = dict()
+        bucket_sizes = np.diff(self.bucket_offsets)
+        signature_upos = np.array([upos for (upos, _, _) in self.signatures])
         for pos in self.upos_filter:
-            replacement_list_length_counter = dict()
-            num_patterns_for_pos = 0
-            for deprel in self.patterns_dict[pos]:
-                num_patterns_for_pos += len(self.patterns_dict[pos][deprel])
-                for deprels_to_children in self.patterns_dict[pos][deprel]:
-                    length = len(self.patterns_dict[pos][deprel][deprels_to_children])
-                    replacement_list_length_counter[length] = replacement_list_length_counter.get(length, 0) + 1
-            total_number_of_replacements = sum([k*v for k,v in replacement_list_length_counter.items()])
-            mean_number_of_replacements = total_number_of_replacements / num_patterns_for_pos
+            sizes = bucket_sizes[signature_upos == pos]
+            num_patterns_for_pos = len(sizes)
+            total_number_of_replacements = int(sizes.sum())
+            mean_number_of_replacements = total_number_of_replacements / num_patterns_for_pos if num_patterns_for_pos else 0.
             res_dict_for_pos = {
                 'No. of patterns': num_patterns_for_pos,
-                'Patterns with one replacement': replacement_list_length_counter[1],
+                'Patterns with one replacement': int((sizes == 1).sum()),
                 'total No. of replacements': total_number_of_replacements,
                 'mean No. of replacements': mean_number_of_replacements
             }
             res_dict[pos] = res_dict_for_pos
         return res_dict
 
-    # a pattern is a tuple (form, lemma, upos, deprel_to_head, list(deprels_to_children))
+    # a pattern is a tuple (form, lemma, deprel_to_head, upos, tuple(deprels_to_children))
     def aggregate_patterns_from_treebank(self, dep_trees, upos_filter=None, verbose=False):
         """Aggregates all patterns from a treebank.
 
-        :param dep_trees: the list of dependency trees (aka the treebank)
+        :param dep_trees: the list of dependency trees (aka the treebank), or a CompactTreebank
         :param upos_filter: a list of upos to filter on. If None, no filtering is done
         :param verbose: whether to print progress information
         :return: a list of patterns"""
+        if isinstance(dep_trees, CompactTreebank):
+            return self.aggregate_patterns_from_compact_treebank(dep_trees, upos_filter=upos_filter, verbose=verbose)
         patterns_nested_list = []
         k = 0
         for tree in dep_trees: 
             new_patterns = self.find_patterns(
                 tree, 
-                patterns=[], 
                 morphfeats=False, 
                 upos_filter=upos_filter)
             patterns_nested_list.append(new_patterns)
@@ -206,52 +866,97 @@ class SyntacticPatterns():
         patterns = [item for sublist in patterns_nested_list for item in sublist]
         return patterns
 
-    def find_patterns(self, dep_tree, patterns=[], morphfeats=False, upos_filter=None):
+    def aggregate_patterns_from_compact_treebank(self, treebank, upos_filter=None, verbose=False):
+        """Aggregates all patterns from a CompactTreebank, without building trees.
+
+        Gives the same patterns as aggregate_patterns_from_treebank on the trees 
+        of the treebank. 
+
+        :param treebank: a CompactTreebank
+        :param upos_filter: a list of upos to filter on. If None, no filtering is done
+        :param verbose: whether to print progress information
+        :return: a list of patterns"""
+        positions, signatures = self.compact_signatures(treebank, upos_filter=upos_filter, verbose=verbose)
+        forms, lemmas = treebank.vocab('form'), treebank.vocab('lemma')
+        form_col = treebank.arrays['form'][positions].tolist()
+        lemma_col = treebank.arrays['lemma'][positions].tolist()
+        return [(forms[f], lemmas[l], deprel, upos, deprels_to_children) 
+                for f, l, (upos, deprel, deprels_to_children) in zip(form_col, lemma_col, signatures)]
+
+    def compact_signatures(self, treebank, upos_filter=None, verbose=False):
+        """Finds the signatures (upos, deprel, tuple of deprels to children) of the tokens of a CompactTreebank.
+
+        Only tokens that are part of the trees (integer ids with a head) are considered.
+
+        :param treebank: a CompactTreebank
+        :param upos_filter: a list of upos to filter on. If None, no filtering is done
+        :param verbose: whether to print progress information
+        :return: a tuple of an array of the token positions in the columns of the treebank, 
+            and the list of their signatures
+        """
+        upos_vocab, deprel_vocab = treebank.vocab('upos'), treebank.vocab('deprel')
+        ids, heads = treebank.ids.tolist(), treebank.heads.tolist()
+        upos_col, deprel_col = treebank.arrays['upos'].tolist(), treebank.arrays['deprel'].tolist()
+        sent_offsets = (treebank.sent_offsets - treebank.sent_offsets[0]).tolist()
+
+        positions = []
+        signatures = []
+        for k in range(len(treebank)):
+            # tree tokens: integer ids with a head (like in TokenList.to_tree)
+            tree_tokens = [t for t in range(sent_offsets[k], sent_offsets[k+1]) if ids[t] >= 0 and heads[t] >= 0]
+            children = dict()
+            for t in tree_tokens:
+                children.setdefault(heads[t], []).append((ids[t], deprel_vocab[deprel_col[t]]))
+            for t in tree_tokens:
+                upos = upos_vocab[upos_col[t]]
+                if upos_filter is None or upos in upos_filter:
+                    deprels_to_children = self.filter_and_sort_deprels_to_children(
+                        upos, 
+                        ids[t], 
+                        children.get(ids[t], []))
+                    positions.append(t)
+                    signatures.append((upos, deprel_vocab[deprel_col[t]], tuple(deprels_to_children)))
+            if verbose and (k+1) % 10000 == 0:
+                print('processed ', k+1, ' trees')
+        return np.array(positions, dtype=np.int64), signatures
+
+    def find_patterns(self, dep_tree, patterns=None, morphfeats=False, upos_filter=None):
         """Finds all patterns in a dependency tree. 
 
         A pattern is defined as a tuple of
         form, lemma, dependency relation to head, upos, dependency relation list to children,
         and optionally morphological features 
 
+        The tree is walked once, iteratively and in pre-order, and the deprels to 
+        the children of each token are read from its subtree. So the patterns come 
+        in the same order as from a recursive walk, without its recursion limit.
+
         :param dep_tree: the dependency tree
-        :param patterns: a list of patterns to find. Always initialize as []
+        :param patterns: a list to append the patterns to. If None, a new list is used
         :param morphfeats: whether to include morphological features in the patterns
         :param upos_filter: a list of upos to filter on. If None, no filtering is done
         :return: a list of patterns
         """
+        patterns = [] if patterns is None else patterns
+        stack = [dep_tree]
+        while stack:
+            subtree = stack.pop()
+            # children are pushed in reverse, so that they are visited in order
+            stack.extend(reversed(subtree.children))
 
-        # basic parts
-        upos = dep_tree.token['upos']
-        # only include the current token if it has the right upos
-        if upos_filter is None or upos in upos_filter:
-            form = dep_tree.token['form']
-            lemma = dep_tree.token['lemma']
-            deprel = dep_tree.token['deprel']
-
-            # feats
-            feats = dep_tree.token['feats']
-            feats = 'EMPTY' if feats is None else str(sorted(feats.items()))
-
-            # morph feats
-            deprels_to_children = self.find_deprels_to_children(
-                dep_tree, 
-                dep_tree.token['id'])
+            token = subtree.token
+            upos = token['upos']
+            # only include the current token if it has the right upos
+            if upos_filter is not None and upos not in upos_filter:
+                continue
+            deprels_to_children = tuple(self.find_deprels_to_children_of_subtree(subtree))
             if morphfeats:
-                tup = (form, lemma, deprel, upos, str(deprels_to_children), feats)
+                feats = 'EMPTY' if token['feats'] is None else str(sorted(token['feats'].items()))
+                patterns.append((token['form'], token['lemma'], token['deprel'], upos, deprels_to_children, feats))
             else:
-                tup = (form, lemma, deprel, upos, str(deprels_to_children))
-            patterns.append(tup)
-
-        # recursive step
-        for c in dep_tree.children:
-            patterns = self.find_patterns(
-                c, 
-                patterns=patterns, 
-                morphfeats=morphfeats, 
-                upos_filter=upos_filter)
+                patterns.append((token['form'], token['lemma'], token['deprel'], upos, deprels_to_children))
         return patterns
 
-
     def find_deprels_to_children(self, dep_tree, i):
         """Returns a list of deprels to children of the token with id i.
 
@@ -261,18 +966,43 @@ class SyntacticPatterns():
         """
         # find relevant subtree
         relevant_subtree = find_subtree_with_token_ix(dep_tree, i)
+        return self.find_deprels_to_children_of_subtree(relevant_subtree)
+
+    def find_deprels_to_children_of_subtree(self, relevant_subtree):
+        """Returns a list of deprels to children of the token at the root of a subtree.
+
+        :param relevant_subtree: a TokenTree
+        :return: a list of deprels to children of the root token
+        """
         # aggregate deprels to children
         children_id_to_deprel = [(c.token['id'], c.token['deprel']) for c in relevant_subtree.children]
+        return self.filter_and_sort_deprels_to_children(
+            relevant_subtree.token['upos'], 
+            relevant_subtree.token['id'], 
+            children_id_to_deprel)
+
+    def filter_and_sort_deprels_to_children(self, upos, i, children_id_to_deprel):
+        """Turns the (id, deprel) pairs of the children of a token into its list of deprels to children.
+
+        Applies the pattern config: drops ignored deprels, adds the token itself as 'MOTHER', 
+        and sorts by id or by deprel.
+
+        :param upos: the upos of the token
+        :param i: the index of the token (aka token['id'])
+        :param children_id_to_deprel: a list of (id, deprel) pairs of the children of the token
+        :return: a list of deprels to children of the token
+        """
         # filter irrelevant dependents:
-        upos = relevant_subtree.token['upos']
         if upos in self.pattern_config['ignore_deprels_for_dependents']:
             old_len = len(children_id_to_deprel)
             children_id_to_deprel = [(c_id, deprel) for c_id, deprel in children_id_to_deprel if deprel not in self.pattern_config['ignore_deprels_for_dependents'][upos]]
             #if old_len > len(children_id_to_deprel):
             #    print('filtered ', old_len - len(children_id_to_deprel), ' children for ', upos)
+        else:
+            children_id_to_deprel = list(children_id_to_deprel)
         # include self at the right spot if requested
         if self.pattern_config['include_self_in_deprels']:
-            children_id_to_deprel.append((relevant_subtree.token['id'],'MOTHER'))
+            children_id_to_deprel.append((i,'MOTHER'))
         # sort by id. Necessary if include_self, if not, it maybe doesn't matter
         children_id_to_deprel.sort(key=lambda x: x[0])
         children_deprels = [c[1] for c in children_id_to_deprel]
@@ -282,28 +1012,67 @@ class SyntacticPatterns():
 
 
 class SyntacticPatternsPOSOnly(SyntacticPatterns):
+    """A baseline without syntactic contexts: every token can be replaced by any 
+    (form, lemma) of its upos.
 
-    def __init__(self, treebank, upos_filter=None, verbose=True, pattern_config=dict()):
-        self.upos_filter = upos_filter
-        self.upos2formlemma = dict()
+    Uses the same index as SyntacticPatterns (and thus the same parallel and cached 
+    builds), with one bucket per upos: the signature of a token is (upos, None, ()).
+    The replacer tries at most max_candidates matches per token, like find_matches_for_token.
+    """
+    max_candidates = 10
+
+    def __init__(self, treebank, upos_filter=None, verbose=True, pattern_config=dict(), num_processes=None):
+        super().__init__(
+            treebank, 
+            upos_filter=upos_filter, 
+            verbose=verbose, 
+            pattern_config=pattern_config, 
+            num_processes=num_processes)
+
+    def aggregate_patterns_from_treebank(self, dep_trees, upos_filter=None, verbose=False):
+        """Aggregates the patterns (form, lemma, None, upos, ()) of all tokens of a treebank.
 
+        :param dep_trees: the list of dependency trees (aka the treebank), or a CompactTreebank
+        :param upos_filter: a list of upos to filter on. If None, no filtering is done
+        :param verbose: whether to print progress information
+        :return: a list of patterns"""
         print('Aggregating patterns...') if verbose else None
-        for i,dep_tree in enumerate(treebank):
-            for token in tokTree2tokSent(dep_tree):
+        if isinstance(dep_trees, CompactTreebank):
+            return self.aggregate_patterns_from_compact_treebank(dep_trees, upos_filter=upos_filter)
+        patterns = []
+        for i,dep_sent in enumerate(tokTrees2tokSents(dep_trees)):
+            for token in dep_sent:
                 upos = token['upos']
-                form = token['form']
-                lemma = token['lemma']
                 if upos_filter is None or upos in upos_filter:
-                    if upos not in self.upos2formlemma:
-                        self.upos2formlemma[upos] = set()
-                    self.upos2formlemma[upos].add((form, lemma))
+                    patterns.append((token['form'], token['lemma'], None, upos, ()))
             if verbose and i % 1000 == 0:
                 print(i, end=", ", flush=True)
-        self.num_patterns = sum([len(ps) for ps in self.upos2formlemma.values()])
+        return patterns
 
-    def find_matches_for_token(self, token, dep_tree, k=10):
-        """Like the superclass method, but returns k random matches."""
+    @property
+    def upos2formlemma(self):
+        """The patterns as a dict upos -> set of (form, lemma). Built from the buckets on every access."""
+        return {upos: set(self.matches_for_signature(sig_id)) for sig_id, (upos, _, _) in enumerate(self.signatures)}
 
-        return random.sample(self.upos2formlemma[token['upos']], k)
+    def compact_signatures(self, treebank, upos_filter=None, verbose=False):
+        """Like the superclass method, but the signatures are (upos, None, ())."""
+        upos_vocab = treebank.vocab('upos')
+        # tree tokens: integer ids with a head (like in TokenList.to_tree)
+        is_tree_token = (treebank.ids >= 0) & (treebank.heads >= 0)
+        if upos_filter is not None:
+            is_tree_token &= np.isin(treebank.arrays['upos'], [i for i, upos in enumerate(upos_vocab) if upos in upos_filter])
+        positions = np.flatnonzero(is_tree_token)
+        return positions, [(upos_vocab[u], None, ()) for u in treebank.arrays['upos'][positions].tolist()]
 
+    def token_signature(self, token, dep_tree):
+        """Returns the signature of a token, i.e. the key of the bucket of its upos."""
+        return (token['upos'], None, ())
 
+    def find_matches_for_token(self, token, dep_tree, k=None, rng=random):
+        """Like the superclass method, but returns at most k (default: max_candidates) random matches, 
+        drawn without replacement in O(k) with rng (see iter_matches)."""
+        k = self.max_candidates if k is None else k
+        sig_id = self.find_signature_id_for_token(token, dep_tree)
+        if sig_id is None:
+            return []
+        return list(itertools.islice(self.iter_matches(sig_id, rng=rng), k))
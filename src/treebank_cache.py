@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from compact_treebank import CompactTreebank
+
+cache_magic = b"SPUDTB01"
+cache_alignment = 8
+
+
+def file_key(filename):
+    """The key of a source file: its absolute path, size and sha1 hash.
+
+    :param filename: the file to compute the key for
+    :return: a dict with the keys 'path', 'size' and 'sha1'
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return {
+        'path': os.path.abspath(filename),
+        'size': os.path.getsize(filename),
+        'sha1': sha1.hexdigest(),
+    }
+
+
+def cache_path(filename, cache_dir):
+    """The path of the cache file for a treebank file."""
+    path_hash = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(filename) + '.' + path_hash + '.spudtb')
+
+
+def save_compiled_treebank(arrays, key, filename):
+    """Writes compiled columns to a single binary file.
+
+    The file starts with a magic string and a json header that holds the
+    source key and the dtype, offset and length of each column. The columns
+    follow as raw, aligned arrays, so they can be memory-mapped.
+
+    :param arrays: a dict of numpy arrays, as returned by compile_treebank
+        (or by syntactic_patterns.pattern_index_to_arrays)
+    :param key: the key of the source file, as returned by file_key
+    :param filename: the file to write to
+    """
+    layout = dict()
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'offset': offset, 'length': len(array)}
+        offset += -(-array.nbytes // cache_alignment) * cache_alignment
+    header = json.dumps({'key': key, 'arrays': layout}).encode('utf-8')
+    header += b' ' * (-len(header) % cache_alignment)
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # write to a temporary file first, so a crash never leaves a broken cache behind
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(cache_magic)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % cache_alignment))
+    os.replace(tmp_filename, filename)
+
+
+def load_compiled_treebank(filename):
+    """Memory-maps a file written by save_compiled_treebank.
+
+    :param filename: the cache file
+    :return: a tuple of the source key and a dict of (read-only, memory-mapped) numpy arrays
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(cache_magic)) != cache_magic:
+            raise ValueError('not a compiled treebank: ' + filename)
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = len(cache_magic) + 8 + header_length
+    arrays = dict()
+    for name, layout in header['arrays'].items():
+        if layout['length'] == 0:
+            arrays[name] = np.zeros(0, dtype=np.dtype(layout['dtype']))
+            continue
+        arrays[name] = np.memmap(
+            filename,
+            dtype=np.dtype(layout['dtype']),
+            mode='r',
+            offset=data_start + layout['offset'],
+            shape=(layout['length'],))
+    return header['key'], arrays
+
+
+def load_compact_treebank(filename, cache_dir, parse_fn, verbose=True):
+    """Loads a treebank as a CompactTreebank through the cache.
+
+    If there is a cache file with the same path, size and hash as the source
+    file, its columns are memory-mapped without parsing. Otherwise the
+    source is parsed with parse_fn and the cache is (re)written.
+
+    :param filename: the filename of the treebank
+    :param cache_dir: the directory of the cache files
+    :param parse_fn: a function filename -> list of tokenlists, used on a cache miss
+    :param verbose: whether to print progress information
+    :return: a CompactTreebank
+    """
+    key = file_key(filename)
+    cached_file = cache_path(filename, cache_dir)
+    if os.path.exists(cached_file):
+        cached_key, arrays = load_compiled_treebank(cached_file)
+        if cached_key == key:
+            print('load cached treebank ', cached_file) if verbose else None
+            return CompactTreebank(arrays)
+        print('cached treebank is stale, parse again') if verbose else None
+    compact_treebank = CompactTreebank.from_sents(parse_fn(filename))
+    print('write treebank cache ', cached_file) if verbose else None
+    save_compiled_treebank(compact_treebank.arrays, key, cached_file)
+    return compact_treebank
@@ -1,4 +1,37 @@
-from conllu import parse
+import functools
+import multiprocessing as mp
+
+from conllu import Metadata, SentenceList, TokenList, parse, parse_incr
+from conllu.parser import DEFAULT_FIELDS
+from compact_treebank import CompactTreebank
+from treebank_cache import load_compact_treebank
+
+def get_token_index(dep_sent):
+    """
+    Get the index token id -> position of a sentence.
+
+    The index is built on first use and stored on the tokenlist, so later 
+    lookups are O(1). Editing token fields other than the id keeps it valid. 
+    It is rebuilt if the length of the sentence changed; after other 
+    structural edits, call invalidate_token_index.
+    :param dep_sent: a tokenlist
+    :return: a dict token id -> position in dep_sent
+    """
+    index = getattr(dep_sent, 'token_index', None)
+    if index is None or index[0] != len(dep_sent):
+        positions = dict()
+        for pos, tok in enumerate(dep_sent):
+            # keep the first token for duplicate ids, like a linear scan would
+            positions.setdefault(tok['id'], pos)
+        index = (len(dep_sent), positions)
+        dep_sent.token_index = index
+    return index[1]
+
+def invalidate_token_index(dep_sent):
+    """
+    Drop the token index of a sentence, e.g. after tokens were inserted, removed or reordered.
+    """
+    dep_sent.token_index = None
 
 def get_token_with_id(dep_sent, id):
     """
@@ -7,10 +40,46 @@ def get_token_with_id(dep_sent, id):
     :param id: the id of the token
     :return: the token with the given id
     """
-    for tok in dep_sent:
-        if tok['id'] == id:
-            return tok
-    return None
+    pos = get_token_index(dep_sent).get(id)
+    if pos is None:
+        return None
+    tok = dep_sent[pos]
+    if tok['id'] != id:
+        # the tokens were rearranged since the index was built
+        invalidate_token_index(dep_sent)
+        return get_token_with_id(dep_sent, id)
+    return tok
+
+def get_head_tokens(dep_sent):
+    """
+    Get the head token of every token of a sentence at once.
+    :param dep_sent: a tokenlist
+    :return: a list with the head token for each token in dep_sent, None for the root 
+        (and for heads that are not in the sentence)
+    """
+    index = get_token_index(dep_sent)
+    return [None if index.get(tok['head']) is None else dep_sent[index[tok['head']]] for tok in dep_sent]
+
+def get_subtree_index(dep_tree):
+    """
+    Get the index token id -> subtree of a tree.
+
+    The subtree of a token holds its children, so this is the children-by-head
+    adjacency of the sentence. The index is built on first use (one pass over 
+    the tree) and stored on the tree.
+    :param dep_tree: a TokenTree
+    :return: a dict token id -> TokenTree
+    """
+    index = getattr(dep_tree, 'subtree_index', None)
+    if index is None:
+        index = dict()
+        stack = [dep_tree]
+        while stack:
+            node = stack.pop()
+            index.setdefault(node.token['id'], node)
+            stack.extend(node.children)
+        dep_tree.subtree_index = index
+    return index
 
 def toklist2tree(toklist):
     """
@@ -22,8 +91,26 @@ def toklist2tree(toklist):
 def tokTree2tokSent(tokTree):
     """
     Convert a TokenTree to a TokenList.
+
+    Walks the tree and sorts the tokens by id, without serializing and 
+    parsing the tree again. Like in toklist2tree, the tokens are shared 
+    between the tree and the tokenlist.
     """
-    return parse(tokTree.serialize())[0]
+    tokens = []
+    stack = [tokTree]
+    while stack:
+        node = stack.pop()
+        tokens.append(node.token)
+        stack.extend(node.children)
+    tokens.sort(key=lambda t: t['id'])
+    metadata = Metadata(tokTree.metadata) if tokTree.metadata is not None else None
+    return TokenList(tokens, metadata, default_fields=DEFAULT_FIELDS)
+
+def tokTrees2tokSents(tokTrees):
+    """
+    Convert a list of TokenTrees (e.g. a whole treebank) to a list of TokenLists.
+    """
+    return [tokTree2tokSent(tokTree) for tokTree in tokTrees]
 
 
 def sent2str(tokenList):
@@ -33,24 +120,117 @@ def sent2str(tokenList):
     return ' '.join([t['form'] for t in tokenList])
 
 def serialize_sents_to_conllu_file(sents, filename):
+    """
+    Writes sentences to a CoNLL-U file.
+    :param sents: an iterable of tokenlists, or a CompactTreebank (which 
+        decodes one sentence at a time)
+    :param filename: the file to write to
+    """
     with open(filename, 'w') as f:
         for sent in map(lambda x:x.serialize(), sents):
             f.write(sent)
 
-def load_ud_treebank(filename, verbose=True, cutoff=None, no_trees=False):
+def iter_ud_treebank(f, cutoff=None, no_trees=False):
+    """
+    Lazily reads a treebank, one sentence at a time.
+
+    Only the sentence that is currently yielded is kept in memory, so this
+    also works for the biggest treebanks (HDT, SynTagRus).
+    :param f: an open file, or the filename of the treebank
+    :param cutoff: the number of sentences to read
+    :param no_trees: whether to yield the trees or only the tokenlists
+    :return: a generator of (tokenlist, tree) pairs, or of tokenlists if no_trees
+    """
+    if isinstance(f, str):
+        with open(f, 'r') as opened_file:
+            yield from iter_ud_treebank(opened_file, cutoff=cutoff, no_trees=no_trees)
+        return
+    for k, dep_sent in enumerate(parse_incr(f)):
+        if cutoff is not None and k >= cutoff:
+            break
+        if no_trees:
+            yield dep_sent
+        else:
+            yield dep_sent, toklist2tree(dep_sent)
+
+def split_at_sentence_boundaries(raw_data, num_chunks):
+    """
+    Splits CoNLL-U text into roughly equal chunks. Chunks only end at blank 
+    lines, so every chunk contains complete sentences.
+    :param raw_data: the CoNLL-U text
+    :param num_chunks: the number of chunks to aim for
+    :return: a list of strings, which concatenate to raw_data
+    """
+    chunk_size = len(raw_data) // num_chunks + 1
+    chunks = []
+    start = 0
+    while start < len(raw_data):
+        boundary = raw_data.find('\n\n', start + chunk_size)
+        if boundary == -1:
+            chunks.append(raw_data[start:])
+            break
+        chunks.append(raw_data[start:boundary + 1])
+        start = boundary + 1
+    return chunks
+
+def parse_chunk(raw_data):
+    """
+    Parses CoNLL-U text into a list of (tokens, metadata) pairs.
+
+    TokenLists can't be unpickled (TokenList.extend needs the metadata before 
+    it is set), so they are sent back from pool workers in this form.
+    """
+    return [(list(dep_sent), dep_sent.metadata) for dep_sent in parse(raw_data)]
+
+def parse_ud_file(filename, num_processes=None):
+    """
+    Parses a CoNLL-U file into a list of tokenlists.
+    :param filename: the filename of the treebank
+    :param num_processes: if > 1, the file is split at sentence boundaries and the 
+        chunks are parsed in a process pool. The result is the same as for the serial parse.
+    :return: a list of tokenlists
+    """
+    with open(filename, 'r') as f:
+        raw_data = f.read()
+    # CoNLL-U Plus files declare their columns in the first line, which only the first chunk would see
+    if num_processes is None or num_processes <= 1 or raw_data.startswith('# global.columns'):
+        return parse(raw_data)
+    # a few chunks per process, so that the processes finish at about the same time
+    chunks = split_at_sentence_boundaries(raw_data, num_processes * 4)
+    del raw_data
+    with mp.Pool(num_processes) as pool:
+        parsed_chunks = pool.map(parse_chunk, chunks)
+    return SentenceList([
+        TokenList(tokens, metadata, default_fields=DEFAULT_FIELDS) 
+        for chunk in parsed_chunks for tokens, metadata in chunk])
+
+def load_ud_treebank(filename, verbose=True, cutoff=None, no_trees=False, stream=False, cache_dir=None, num_processes=None, compact=False):
     """
     Loads a treebank from a file.
     :param filename: the filename of the treebank
     :param verbose: whether to print progress information
     :param cutoff: the number of sentences to load
     :param no_trees: whether to load the trees or only the tokenlists
+    :param stream: if True, return a generator (see iter_ud_treebank) instead of lists
+    :param cache_dir: if not None, the parsed treebank is cached in this directory 
+        (see treebank_cache.py), and later loads of the unchanged file skip parsing
+    :param num_processes: the number of processes for parsing (see parse_ud_file)
+    :param compact: if True, return a CompactTreebank instead of lists (no_trees is ignored)
     :return: a tuple of the list of tokenlists, and a map object for the trees"""
     print("read file ", filename) if verbose else None 
-    with open(filename, 'r') as f:
-        raw_data = f.readlines()
-    raw_data = ''.join(raw_data)
+    if stream:
+        return iter_ud_treebank(filename, cutoff=cutoff, no_trees=no_trees)
     print('parse data into token lists') if verbose else None
-    dep_sents = parse(raw_data)
+    parse_fn = functools.partial(parse_ud_file, num_processes=num_processes)
+    if cache_dir is not None:
+        compact_treebank = load_compact_treebank(filename, cache_dir, parse_fn, verbose=verbose)
+        if compact:
+            return compact_treebank[:cutoff]
+        dep_sents = compact_treebank.to_sents(cutoff=cutoff)
+    elif compact:
+        return CompactTreebank.from_sents(parse_fn(filename))[:cutoff]
+    else:
+        dep_sents = parse_fn(filename)
     print('apply cutoff of ', cutoff) if verbose else None
     if cutoff is not None:
         dep_sents = dep_sents[:cutoff]
@@ -60,7 +240,6 @@ def load_ud_treebank(filename, verbose=True, cutoff=None, no_trees=False):
     print('convert token lists to trees') if verbose else None
     dep_trees = list(map(toklist2tree, dep_sents))
     print('Done parsing')
-    del raw_data
     return dep_sents, dep_trees
 
 def create_markup_for_tok_list_pair(toklist1, toklist2, markup="**"):